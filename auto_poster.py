@@ -7,14 +7,28 @@
 """
 
 import argparse
+import contextlib
+import cProfile
+import csv
+import hashlib
 import io
 import json
 import logging
+import math
 import os
 import pickle
 import re
+import signal
+import sqlite3
+import struct
+import subprocess
 import sys
 import time
+import tracemalloc
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 from typing import Dict, List, Optional
 from urllib.parse import urljoin
@@ -23,6 +37,9 @@ import requests
 import undetected_chromedriver as uc
 from bs4 import BeautifulSoup
 from PIL import Image, ImageDraw, ImageFont
+from PIL.PngImagePlugin import PngInfo
+from selenium import webdriver
+from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
@@ -42,8 +59,16 @@ log = logging.getLogger("poster")
 # ═══════════════════════════════════════════════════════════════════════════
 BASE_URL = "https://www.automobile-catalog.com"
 COOKIES_FILE = Path("cookies_selenium.pkl")
+QUOTA_STATE_FILE = Path("api_quota.json")
+PHOTO_CACHE_DIR = Path("photo_cache")
+BATCH_JOURNAL_FILE = Path("batch_journal.jsonl")
+PAGE_ARCHIVE_FILE = Path("page_archive.sqlite")
+BROWSER_STATE_FILE = Path("browser_session.json")
+BROWSER_PROFILE_DIR = Path("chrome_profile")
+CHROME_BINARY = os.getenv("CHROME_BINARY", "")  # По умолчанию — найденный uc
 REMOVEBG_API_KEY = os.getenv("REMOVEBG_API_KEY", "")
 UNSPLASH_ACCESS_KEY = os.getenv("UNSPLASH_ACCESS_KEY", "")
+FALLBACK_DB_PATH = os.getenv("FALLBACK_DB_PATH", "")  # Внешний датасет (CSV или SQLite)
 
 # Страны производителей
 BRAND_COUNTRIES = {
@@ -60,6 +85,7 @@ BRAND_COUNTRIES = {
 }
 
 # Fallback база (только для дополнения недостающих данных!)
+# Встроенный минимум — большие датасеты подключаются через FallbackStore
 FALLBACK_DB = {
     "bmw m4": {
         "model": "BMW M4", "engine": "3.0L TwinTurbo", "power": "503 HP",
@@ -117,25 +143,358 @@ def print_banner():
     print()
 
 
+# ═══════════════════════════════════════════════════════════════════════════
+#  ПРОФИЛИРОВАНИЕ ЭТАПОВ
+# ═══════════════════════════════════════════════════════════════════════════
+class StageProfiler:
+    """
+    Опциональное профилирование этапов конвейера: cProfile (свой профиль
+    на каждый этап, .pstats) и tracemalloc (пик и топ мест аллокаций).
+    Выключенный профайлер отдаёт общий nullcontext — без накладных расходов.
+    Вложенные этапы (remove.bg внутри загрузки фото, кодирование полос
+    внутри рендера) по CPU считаются отдельно, по памяти — включительно.
+    """
+
+    STAGES = ('scrape', 'parse', 'image_fetch', 'bg_removal', 'render', 'encode')
+    TOP_SITES = 15
+
+    def __init__(self):
+        self.enabled = False
+        self.cpu = False
+        self.memory = False
+        self.out_dir: Optional[Path] = None
+        self._null = contextlib.nullcontext()
+        self._stack: List[Dict] = []
+        self._profiles: Dict[str, cProfile.Profile] = {}
+        self._stats: Dict[str, Dict] = {}
+
+    def configure(self, out_dir: str, cpu: bool = False, memory: bool = False):
+        self.cpu, self.memory = cpu, memory
+        self.enabled = cpu or memory
+        if not self.enabled:
+            return
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        log.info(f"Profiling enabled (cpu={cpu}, memory={memory}), reports: {self.out_dir}")
+
+    def stage(self, name: str, trace_memory: bool = True):
+        """
+        trace_memory=False — для частых коротких этапов внутри другого
+        (кодирование полос в рендере): только время и CPU-профиль, без
+        снимков tracemalloc на каждый вызов; память учитывается во внешнем.
+        """
+        if not self.enabled:
+            return self._null
+        return self._profile_stage(name, self.memory and trace_memory)
+
+    @contextlib.contextmanager
+    def _profile_stage(self, name: str, memory: bool):
+        outer = self._stack[-1] if self._stack else None
+        entry = {'name': name, 'base': 0, 'peak': 0, 'snapshot': None}
+        
+        # cProfile допускает только один активный профиль; снимки
+        # tracemalloc не должны попадать в CPU-профиль этапа
+        if self.cpu and outer:
+            self._profiles[outer['name']].disable()
+        if memory:
+            if outer:
+                outer['peak'] = max(outer['peak'], tracemalloc.get_traced_memory()[1])
+            entry['snapshot'] = self._snapshot()
+            tracemalloc.reset_peak()
+            entry['base'] = entry['peak'] = tracemalloc.get_traced_memory()[0]
+        profile = None
+        if self.cpu:
+            profile = self._profiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+        
+        self._stack.append(entry)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            if profile:
+                profile.disable()
+            self._stack.pop()
+            
+            stats = self._stats.setdefault(name, {'calls': 0, 'seconds': 0.0, 'traced': 0,
+                                                  'peak': 0, 'sites': {}})
+            stats['calls'] += 1
+            stats['seconds'] += elapsed
+            if memory:
+                stats['traced'] += 1
+                peak = max(entry['peak'], tracemalloc.get_traced_memory()[1])
+                stats['peak'] = max(stats['peak'], peak - entry['base'])
+                for diff in self._snapshot().compare_to(entry['snapshot'], 'lineno'):
+                    if diff.size_diff > 0:
+                        site = str(diff.traceback[0])
+                        stats['sites'][site] = stats['sites'].get(site, 0) + diff.size_diff
+                if outer:
+                    outer['peak'] = max(outer['peak'], peak)
+                tracemalloc.reset_peak()
+            if self.cpu and outer:
+                self._profiles[outer['name']].enable()
+
+    @staticmethod
+    def _snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, contextlib.__file__),
+        ])
+
+    def dump(self):
+        """Пишет <stage>.pstats и memory_report.txt, выводит сводку по этапам."""
+        if not self.enabled or not self._stats:
+            return
+        
+        for name, profile in self._profiles.items():
+            profile.dump_stats(str(self.out_dir / f"{name}.pstats"))
+        
+        log.info("Stage profile:")
+        for name in self.STAGES:
+            stats = self._stats.get(name)
+            if stats:
+                peak = f", peak {stats['peak'] / 1024 / 1024:.1f} MB" if stats['traced'] else ""
+                log.info(f"  {name:<11} {stats['calls']:>4} calls  {stats['seconds']:8.2f}s{peak}")
+        
+        if self.memory:
+            report = self.out_dir / "memory_report.txt"
+            with open(report, 'w', encoding='utf-8') as f:
+                f.write("Python heap per stage (tracemalloc; Pillow pixel buffers are "
+                        "allocated natively and not included)\n")
+                for name in self.STAGES:
+                    stats = self._stats.get(name)
+                    if not stats:
+                        continue
+                    if not stats['traced']:
+                        f.write(f"\n[{name}] calls: {stats['calls']}, not traced separately "
+                                f"(included in the enclosing stage)\n")
+                        continue
+                    f.write(f"\n[{name}] calls: {stats['calls']}, "
+                            f"peak above stage start: {stats['peak'] / 1024:.1f} KiB\n")
+                    f.write("  retained allocations, top sites:\n")
+                    top = sorted(stats['sites'].items(), key=lambda kv: kv[1], reverse=True)
+                    for site, size in top[:self.TOP_SITES]:
+                        f.write(f"  {size / 1024:10.1f} KiB  {site}\n")
+            log.info(f"Memory report: {report}")
+        if self.cpu:
+            log.info(f"CPU profiles: {self.out_dir}/<stage>.pstats "
+                     f"(python -m pstats {self.out_dir / 'render.pstats'})")
+
+
+profiler = StageProfiler()
+
+
 # ═══════════════════════════════════════════════════════════════════════════
 #  WEB SCRAPER
 # ═══════════════════════════════════════════════════════════════════════════
+CLOUDFLARE_MARKERS = ['cloudflare', 'checking your browser', 'just a moment',
+                      'verify you are human', 'security check']
+
+# Блокировка тяжёлых ресурсов: нам нужны только ссылки, h1 и текст.
+# Всё блокируется через DevTools (Network.setBlockedURLs), чтобы блокировку
+# можно было снять на время Cloudflare челленджа.
+# Картинки, шрифты, стили, медиа — только с хоста каталога: паттерны не
+# задевают challenges.cloudflare.com (исключений setBlockedURLs не умеет)
+SITE_HOST = BASE_URL.split('//', 1)[1].removeprefix('www.')
+BLOCKED_ASSET_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif', 'webp', 'svg', 'ico',
+                            'woff', 'ttf', 'otf', 'eot', 'css', 'mp4', 'webm']
+BLOCKED_URL_PATTERNS = [f'*{SITE_HOST}/*.{ext}*' for ext in BLOCKED_ASSET_EXTENSIONS] + [
+    # Реклама, аналитика, сторонние скрипты
+    '*googlesyndication.com*', '*doubleclick.net*', '*google-analytics.com*',
+    '*googletagmanager.com*', '*googletagservices.com*', '*adservice.google.*',
+    '*fundingchoicesmessages.google.com*', '*amazon-adsystem.com*', '*facebook.net*',
+    '*criteo.*', '*taboola.com*', '*outbrain.com*', '*quantserve.com*',
+    '*scorecardresearch.com*', '*hotjar.com*', '*pubmatic.com*', '*rubiconproject.com*',
+]
+
+# Скрипты извлечения прямо в браузере: по WebDriver передаются только
+# нужные данные, а не весь DOM (page_source) для разбора в Python.
+_JS_CHALLENGE = """
+const markers = arguments[0];
+const title = (document.title || '').toLowerCase();
+const text = (document.documentElement ? document.documentElement.textContent : '').toLowerCase();
+return markers.some(m => title.includes(m) || text.includes(m));
+"""
+
+_JS_MODEL_LINKS = """
+const clean = s => (s || '').replace(/\\s+/g, ' ').trim();
+const out = [];
+for (const a of document.querySelectorAll('a[href*="/car/"], a[href*="/model/"]')) {
+    out.push({
+        href: a.getAttribute('href') || '',
+        text: clean(a.textContent),
+        title: a.getAttribute('title') || '',
+        alt: a.getAttribute('alt') || '',
+    });
+}
+return out;
+"""
+
+_JS_SPEC_ROWS = """
+const clean = s => (s || '').replace(/\\s+/g, ' ').trim();
+const h1 = document.querySelector('h1');
+const rows = [];
+for (const tr of document.querySelectorAll('table tr')) {
+    if (tr.querySelector('table')) continue;   // layout-таблицы дублируют вложенный текст
+    const cells = Array.from(tr.cells, c => clean(c.textContent)).filter(Boolean);
+    if (cells.length) rows.push(cells);
+}
+return {
+    h1: h1 ? clean(h1.textContent) : '',
+    title: clean(document.title),
+    rows: rows,
+    text: rows.length ? '' : (document.body ? document.body.innerText : ''),
+};
+"""
+
+
+def _clean_text(text: str) -> str:
+    """Как clean() в скриптах выше: схлопывает пробельные символы."""
+    return re.sub(r'\s+', ' ', text or '').strip()
+
+
+def browser_version(address: str, timeout: float = 2) -> Optional[Dict]:
+    """Health check браузера по DevTools endpoint; None — не отвечает."""
+    try:
+        response = requests.get(f"http://{address}/json/version", timeout=timeout)
+        return response.json() if response.status_code == 200 else None
+    except (requests.RequestException, ValueError):
+        return None
+
+
+class ManagedBrowser:
+    """
+    Долгоживущий Chrome с DevTools портом и собственным профилем.
+    Запускается один раз (--start-browser), следующие запуски скрипта
+    подключаются к нему: тёплый кэш, DNS и сессия Cloudflare сохраняются.
+    Если браузер умер — запускается заново.
+    """
+
+    def __init__(self, port: int = 9222, profile_dir: Path = None, state_file: Path = None):
+        self.port = port
+        self.address = f"127.0.0.1:{port}"
+        self.profile_dir = Path(profile_dir or BROWSER_PROFILE_DIR)
+        self.state_file = Path(state_file or BROWSER_STATE_FILE)
+
+    def is_alive(self) -> bool:
+        return browser_version(self.address) is not None
+
+    def start(self, timeout: float = 30) -> str:
+        if self.is_alive():
+            log.info(f"Managed browser already running at {self.address}")
+            return self.address
+        
+        binary = CHROME_BINARY or uc.find_chrome_executable()
+        if not binary:
+            raise RuntimeError("Chrome executable not found (set CHROME_BINARY)")
+        args = [
+            binary,
+            f"--remote-debugging-port={self.port}",
+            f"--user-data-dir={self.profile_dir.resolve()}",
+            '--no-first-run',
+            '--no-default-browser-check',
+            '--no-sandbox',
+            '--disable-dev-shm-usage',
+            '--disable-blink-features=AutomationControlled',
+            '--start-maximized',
+        ]
+        # Браузер переживает процесс скрипта
+        if os.name == 'nt':
+            detach = {'creationflags': subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP}
+        else:
+            detach = {'start_new_session': True}
+        
+        log.info(f"Starting managed browser at {self.address} (profile: {self.profile_dir})...")
+        process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, **detach)
+        with open(self.state_file, 'w', encoding='utf-8') as f:
+            json.dump({'pid': process.pid, 'address': self.address, 'started': time.time()}, f)
+        
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.is_alive():
+                log.info(f"Managed browser is up (pid {process.pid})")
+                return self.address
+            if process.poll() is not None:
+                raise RuntimeError(f"Browser exited with code {process.returncode}")
+            time.sleep(0.5)
+        raise RuntimeError(f"Browser did not open DevTools at {self.address} in {timeout:.0f}s")
+
+    def ensure(self) -> str:
+        """Адрес живого браузера; упавший или не запущенный — перезапускает."""
+        if self.is_alive():
+            return self.address
+        log.warning(f"Managed browser at {self.address} is not running, relaunching...")
+        return self.start()
+
+    def stop(self):
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                pid = json.load(f)['pid']
+        except (OSError, ValueError, KeyError):
+            log.info(f"No managed browser recorded in {self.state_file}")
+            return
+        if not self.is_alive():
+            # Браузер уже умер — pid мог достаться другому процессу
+            log.info(f"Managed browser at {self.address} is not running")
+            self.state_file.unlink(missing_ok=True)
+            return
+        try:
+            os.kill(pid, signal.SIGTERM)
+            log.info(f"Managed browser stopped (pid {pid})")
+        except OSError as e:
+            log.warning(f"Could not stop browser pid {pid}: {e}")
+        self.state_file.unlink(missing_ok=True)
+
+
 class AutoCatalogScraper:
-    def __init__(self):
+    def __init__(self, extract_mode: str = "script", block_resources: bool = True,
+                 page_stats: bool = False, archive: Optional["PageArchive"] = None,
+                 debugger_address: str = "", managed_browser: Optional[ManagedBrowser] = None):
         self.driver = None
+        # Подключение к уже запущенному Chrome вместо запуска своего
+        self.debugger_address = debugger_address
+        self.managed_browser = managed_browser
+        self.attached = False
         self.cookies_file = COOKIES_FILE
+        # "script" — извлечение в браузере через execute_script,
+        # "soup" — полный page_source + BeautifulSoup (старый режим)
+        self.extract_mode = extract_mode
+        self.block_resources = block_resources
+        self.page_stats = page_stats      # Байты / время загрузки по каждой странице
+        self.archive = archive            # Сохранять сырой HTML для офлайн reparse
+        self._blocking_active = False
+        self._stats = []
         
+    def _run_script(self, script: str, *args):
+        """execute_script в режиме "script"; None — использовать page_source."""
+        if self.extract_mode != "script":
+            return None
+        try:
+            return self.driver.execute_script(script, *args)
+        except Exception as e:
+            log.debug(f"In-browser extraction failed, falling back to page_source: {e}")
+            return None
+    
     def init_driver(self):
-        log.info("Initializing ChromeDriver...")
-        options = uc.ChromeOptions()
-        options.add_argument('--no-sandbox')
-        options.add_argument('--disable-dev-shm-usage')
-        options.add_argument('--disable-blink-features=AutomationControlled')
+        address = self.debugger_address
+        if self.managed_browser:
+            address = self.managed_browser.ensure()
+        elif address and browser_version(address) is None:
+            log.warning(f"No browser is answering at {address}, launching a new one")
+            address = ""
         
-        self.driver = uc.Chrome(options=options, version_main=None)
-        self.driver.maximize_window()
+        self.attached = bool(address)
+        self.driver = self._attach_driver(address) if address else self._launch_driver()
         
-        if self.cookies_file.exists():
+        if self.block_resources:
+            self._set_blocking(True)
+        
+        # У подключённого браузера cookies уже лежат в его профиле
+        if self.cookies_file.exists() and not self.attached:
             log.info(f"Loading saved cookies from {self.cookies_file}")
             try:
                 self.driver.get(BASE_URL)
@@ -154,8 +513,130 @@ class AutoCatalogScraper:
             except Exception as e:
                 log.warning(f"Could not load cookies: {e}")
         
+        if self.page_stats:
+            # Навигации инициализации (cookies) не должны попасть в статистику первой страницы
+            try:
+                self.driver.get_log('performance')
+            except Exception as e:
+                log.debug(f"Could not drain performance log: {e}")
+        
         return self.driver
     
+    def _launch_driver(self):
+        log.info("Initializing ChromeDriver...")
+        options = uc.ChromeOptions()
+        options.add_argument('--no-sandbox')
+        options.add_argument('--disable-dev-shm-usage')
+        options.add_argument('--disable-blink-features=AutomationControlled')
+        if self.page_stats:
+            options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+        
+        driver = uc.Chrome(options=options, version_main=None)
+        driver.maximize_window()
+        return driver
+    
+    def _attach_driver(self, address: str):
+        """
+        Подключение chromedriver к запущенному Chrome (debuggerAddress).
+        Для работы открывается своя вкладка — чужие вкладки не трогаем.
+        """
+        log.info(f"Attaching to running Chrome at {address}...")
+        options = webdriver.ChromeOptions()
+        options.debugger_address = address
+        if self.page_stats:
+            options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+        
+        try:
+            # Тот же патченный chromedriver, что и у uc.Chrome, под версию браузера
+            browser = (browser_version(address) or {}).get('Browser', '')
+            match = re.search(r'/(\d+)\.', browser)
+            patcher = uc.Patcher(version_main=int(match.group(1)) if match else 0)
+            patcher.auto()
+            driver = webdriver.Chrome(service=Service(patcher.executable_path), options=options)
+        except Exception as e:
+            log.warning(f"Patched chromedriver unavailable ({e}), using the default one")
+            driver = webdriver.Chrome(options=options)
+        
+        driver.switch_to.new_window('tab')
+        return driver
+    
+    def ensure_driver(self):
+        """Health check сессии перед загрузкой страницы; мёртвый браузер — перезапуск."""
+        if self.driver is not None:
+            try:
+                self.driver.current_window_handle
+                return self.driver
+            except Exception as e:
+                log.warning(f"Browser session is not responding ({e.__class__.__name__}), relaunching...")
+                self._release_driver()
+        return self.init_driver()
+    
+    def _release_driver(self):
+        """Завершает сессию; подключённый браузер не закрывается — только своя вкладка."""
+        try:
+            if self.attached:
+                try:
+                    self.driver.close()
+                finally:
+                    # chromedriver останавливаем, даже если вкладка уже закрыта
+                    self.driver.service.stop()
+            else:
+                self.driver.quit()
+        except Exception:
+            pass
+        self.driver = None
+    
+    def _set_blocking(self, enabled: bool):
+        """Включает / снимает блокировку URL через DevTools."""
+        try:
+            self.driver.execute_cdp_cmd('Network.enable', {})
+            self.driver.execute_cdp_cmd('Network.setBlockedURLs',
+                                        {'urls': BLOCKED_URL_PATTERNS if enabled else []})
+            self._blocking_active = enabled
+        except Exception as e:
+            log.warning(f"Could not {'enable' if enabled else 'disable'} resource blocking: {e}")
+    
+    def _record_page_stats(self, url: str, started: float):
+        """Логирует объём трафика и время загрузки страницы (по performance log)."""
+        if not self.page_stats:
+            return
+        transferred = requests_count = blocked = 0
+        try:
+            for entry in self.driver.get_log('performance'):
+                message = json.loads(entry['message'])['message']
+                if message['method'] == 'Network.loadingFinished':
+                    transferred += message['params'].get('encodedDataLength', 0)
+                    requests_count += 1
+                elif message['method'] == 'Network.loadingFailed':
+                    if message['params'].get('blockedReason'):
+                        blocked += 1
+            load_ms = self.driver.execute_script(
+                "const n = performance.getEntriesByType('navigation')[0];"
+                "return n && n.loadEventEnd ? n.loadEventEnd - n.startTime : null;"
+            )
+        except Exception as e:
+            log.debug(f"Could not collect page stats: {e}")
+            return
+        if not load_ms:
+            load_ms = (time.time() - started) * 1000
+        
+        stat = {
+            'url': url, 'bytes': transferred, 'requests': requests_count,
+            'blocked': blocked, 'load_ms': load_ms, 'blocking': self._blocking_active,
+        }
+        self._stats.append(stat)
+        log.info(f"Page stats: {transferred / 1024:.0f} KB, {requests_count} requests, "
+                 f"{blocked} blocked, load {load_ms:.0f} ms "
+                 f"(blocking {'on' if self._blocking_active else 'off'}) — {url}")
+    
+    def _log_stats_summary(self):
+        if not self._stats:
+            return
+        total_bytes = sum(s['bytes'] for s in self._stats)
+        avg_ms = sum(s['load_ms'] for s in self._stats) / len(self._stats)
+        log.info(f"Page stats total: {len(self._stats)} pages, {total_bytes / 1024:.0f} KB, "
+                 f"avg load {avg_ms:.0f} ms (blocking {'on' if self.block_resources else 'off'})")
+    
     def save_cookies(self):
         try:
             cookies = self.driver.get_cookies()
@@ -173,15 +654,16 @@ class AutoCatalogScraper:
         
         while time.time() - start_time < max_wait:
             try:
-                page_source = self.driver.page_source.lower()
-                title = self.driver.title.lower()
-                
-                if any(keyword in page_source or keyword in title for keyword in 
-                       ['cloudflare', 'checking your browser', 'just a moment', 
-                        'verify you are human', 'security check']):
+                if self._challenge_present():
                     
                     if not cloudflare_detected:
                         cloudflare_detected = True
+                        if self._blocking_active:
+                            # Allowlist: на время челленджа страница грузится целиком
+                            log.info("Suspending resource blocking for the challenge")
+                            self._set_blocking(False)
+                            # Уже заблокированные ресурсы сами не догрузятся
+                            self.driver.refresh()
                         log.warning("CLOUDFLARE DETECTED!")
                         log.warning("=" * 70)
                         log.warning("  Please complete the CAPTCHA in the browser window")
@@ -198,6 +680,8 @@ class AutoCatalogScraper:
                 if cloudflare_detected:
                     print()
                     log.info("Cloudflare challenge passed!")
+                    if self.block_resources:
+                        self._set_blocking(True)
                     self.save_cookies()
                     time.sleep(2)
                     return True
@@ -212,30 +696,61 @@ class AutoCatalogScraper:
         if cloudflare_detected:
             print()
             log.error("Cloudflare timeout")
+            if self.block_resources:
+                self._set_blocking(True)
             return False
         
         return True
     
-    def search_car(self, brand: str, model: str = "") -> List[Dict]:
+    def _challenge_present(self) -> bool:
+        detected = self._run_script(_JS_CHALLENGE, CLOUDFLARE_MARKERS)
+        if detected is not None:
+            return bool(detected)
+        page_source = self.driver.page_source.lower()
+        title = self.driver.title.lower()
+        return any(keyword in page_source or keyword in title for keyword in CLOUDFLARE_MARKERS)
+    
+    @staticmethod
+    def brand_list_url(brand: str) -> str:
+        brand_slug = brand.lower().replace(' ', '-')
+        return f"{BASE_URL}/list-{brand_slug}.html"
+    
+    def _archive_page(self, url: str, kind: str, html: Optional[str] = None, extract: str = ""):
+        """
+        Сохраняет сырой HTML текущей вкладки в архив (если он включён)
+        вместе с режимом извлечения, которым страница была разобрана.
+        """
+        if self.archive is None:
+            return
         try:
-            if not self.driver:
-                self.init_driver()
+            self.archive.put(url, html if html is not None else self.driver.page_source,
+                             kind, extract)
+        except Exception as e:
+            log.warning(f"Could not archive {url}: {e}")
+    
+    def search_car(self, brand: str, model: str = "", limit: Optional[int] = 20) -> List[Dict]:
+        try:
+            self.ensure_driver()
             
             log.info(f"Searching for: {brand} {model}")
             
-            brand_slug = brand.lower().replace(' ', '-')
-            list_url = f"{BASE_URL}/list-{brand_slug}.html"
+            list_url = self.brand_list_url(brand)
             
             log.info(f"Opening brand list: {list_url}")
-            self.driver.get(list_url)
-            
-            if not self.wait_for_cloudflare():
-                log.error("Failed to bypass Cloudflare")
-                return []
-            
-            time.sleep(3)
+            started = time.time()
+            with profiler.stage('scrape'):
+                self.driver.get(list_url)
+                
+                if not self.wait_for_cloudflare():
+                    log.error("Failed to bypass Cloudflare")
+                    return []
+                
+                time.sleep(3)
+                self._record_page_stats(list_url, started)
+                self._archive_page(list_url, 'list')
             
-            results = self._parse_model_list(model)
+            with profiler.stage('parse'):
+                results = self._parse_model_list(model, limit)
             
             if results:
                 log.info(f"Found {len(results)} models")
@@ -250,79 +765,228 @@ class AutoCatalogScraper:
             log.error(f"Search failed: {e}")
             return []
     
-    def _parse_model_list(self, model_query: str = "") -> List[Dict]:
-        results = []
+    def _parse_model_list(self, model_query: str = "", limit: Optional[int] = 20) -> List[Dict]:
         try:
-            soup = BeautifulSoup(self.driver.page_source, 'html.parser')
-            
-            model_links = []
-            
-            for a in soup.find_all('a', href=re.compile(r'/model/\w+/[\w\-_]+')):
-                model_links.append(a)
-            
-            for a in soup.find_all('a', href=re.compile(r'/car/\d+/\w+/[\w\-_]+')):
-                model_links.append(a)
-            
-            for a in soup.find_all('a', href=True):
-                href = a.get('href', '')
-                if '/car/' in href or '/model/' in href:
-                    if a not in model_links:
-                        model_links.append(a)
-            
-            seen_urls = set()
-            for link in model_links:
-                href = link.get('href', '')
-                if not href or href in seen_urls:
-                    continue
-                
-                if any(skip in href for skip in ['#', 'javascript:', 'mailto:', '.css', '.js']):
-                    continue
-                
-                full_url = urljoin(BASE_URL, href)
-                text = link.get_text(strip=True)
-                
-                if not text:
-                    text = link.get('title', '') or link.get('alt', '')
-                
-                if text and len(text) > 2:
-                    results.append({
-                        'name': text,
-                        'url': full_url
-                    })
-                    seen_urls.add(href)
-            
-            if model_query:
-                model_lower = model_query.lower()
-                exact_matches = [r for r in results if model_lower in r['name'].lower()]
-                other_matches = [r for r in results if model_lower not in r['name'].lower()]
-                results = exact_matches + other_matches
-            
-            return results[:20]
+            anchors = self._run_script(_JS_MODEL_LINKS)
+            if anchors is None:
+                anchors = self.soup_model_anchors(self.driver.page_source)
+            return self.select_model_links(anchors, model_query, limit)
             
         except Exception as e:
             log.error(f"Error parsing model list: {e}")
             return []
     
+    @staticmethod
+    def soup_model_anchors(html: str) -> List[Dict]:
+        """Ссылки на модели из HTML (формат как у _JS_MODEL_LINKS)."""
+        soup = BeautifulSoup(html, 'html.parser')
+        return [
+            {
+                'href': a.get('href', ''),
+                'text': _clean_text(a.get_text()),
+                'title': a.get('title', ''),
+                'alt': a.get('alt', ''),
+            }
+            for a in soup.find_all('a', href=True)
+            if '/car/' in a['href'] or '/model/' in a['href']
+        ]
+    
+    @staticmethod
+    def select_model_links(anchors: List[Dict], model_query: str = "",
+                           limit: Optional[int] = 20) -> List[Dict]:
+        """Фильтрует и ранжирует ссылки на модели: [{'name', 'url'}, ...]."""
+        results = []
+        
+        # Порядок: /model/... → /car/<id>/... → прочие ссылки на модели
+        model_links = [a for a in anchors if re.search(r'/model/\w+/[\w\-_]+', a['href'])]
+        model_links += [a for a in anchors if re.search(r'/car/\d+/\w+/[\w\-_]+', a['href'])]
+        ranked = {id(a) for a in model_links}
+        model_links += [a for a in anchors if id(a) not in ranked]
+        
+        seen_urls = set()
+        for link in model_links:
+            href = link.get('href', '')
+            if not href or href in seen_urls:
+                continue
+            
+            if any(skip in href for skip in ['#', 'javascript:', 'mailto:', '.css', '.js']):
+                continue
+            
+            full_url = urljoin(BASE_URL, href)
+            text = link.get('text', '')
+            
+            if not text:
+                text = link.get('title', '') or link.get('alt', '')
+            
+            if text and len(text) > 2:
+                results.append({
+                    'name': text,
+                    'url': full_url
+                })
+                seen_urls.add(href)
+        
+        if model_query:
+            model_lower = model_query.lower()
+            exact_matches = [r for r in results if model_lower in r['name'].lower()]
+            other_matches = [r for r in results if model_lower not in r['name'].lower()]
+            results = exact_matches + other_matches
+        
+        return results[:limit]
+    
     def parse_specs(self, url: str) -> Dict:
         try:
+            self.ensure_driver()
+            
             log.info(f"Parsing specs from: {url}")
-            self.driver.get(url)
-            time.sleep(4)
+            started = time.time()
+            with profiler.stage('scrape'):
+                self.driver.get(url)
+                time.sleep(4)
+                self._record_page_stats(url, started)
             
-            soup = BeautifulSoup(self.driver.page_source, 'html.parser')
+            with profiler.stage('parse'):
+                return self._extract_page_specs(url)
+            
+        except Exception as e:
+            log.error(f"Failed to parse specs: {e}")
+            return {}
+    
+    def _extract_page_specs(self, url: str = "") -> Dict:
+        """
+        Характеристики со страницы, открытой в текущей вкладке. Страница
+        архивируется с фактически использованным режимом извлечения —
+        офлайн reparse разбирает её тем же способом.
+        """
+        data = self._run_script(_JS_SPEC_ROWS)
+        if data is not None:
+            h1_text, page_text = self.spec_rows_text(data)
+            if url:
+                self._archive_page(url, 'specs', extract='script')
+        else:
+            html = self.driver.page_source
+            h1_text, page_text = self.soup_spec_text(html)
+            if url:
+                self._archive_page(url, 'specs', html, extract='soup')
+        
+        return self.extract_specs(h1_text, page_text)
+    
+    def parse_specs_many(self, urls: List[str], max_tabs: int = 4,
+                         page_timeout: int = 60) -> List[Dict]:
+        """
+        Характеристики для нескольких страниц: загружаются параллельно в
+        max_tabs вкладках одного драйвера, пачками. Навигация запускается
+        через JS (не блокирует), поэтому пачка грузится за время одной
+        страницы. Результат выровнен по urls ({} — не удалось).
+        """
+        if not urls:
+            return []
+        
+        self.ensure_driver()
+        main_handle = self.driver.current_window_handle
+        handles = [main_handle]
+        results = []
+        try:
+            while len(handles) < min(max_tabs, len(urls)):
+                self.driver.switch_to.new_window('tab')
+                handles.append(self.driver.current_window_handle)
+                # setBlockedURLs действует на одну вкладку (CDP target)
+                if self.block_resources:
+                    self._set_blocking(True)
+            
+            for start in range(0, len(urls), len(handles)):
+                batch = urls[start:start + len(handles)]
+                log.info(f"Loading spec pages {start + 1}-{start + len(batch)}/{len(urls)} "
+                         f"in {len(batch)} tabs")
+                started = time.time()
+                
+                # Запускаем все загрузки пачки; маркер пропадёт вместе со старым документом
+                with profiler.stage('scrape'):
+                    for handle, url in zip(handles, batch):
+                        self.driver.switch_to.window(handle)
+                        self.driver.execute_script(
+                            "window.__posterNav = true; window.location.href = arguments[0];", url
+                        )
+                
+                for handle, url in zip(handles, batch):
+                    self.driver.switch_to.window(handle)
+                    try:
+                        with profiler.stage('scrape'):
+                            WebDriverWait(self.driver, page_timeout).until(lambda d: d.execute_script(
+                                "return !window.__posterNav && document.readyState === 'complete';"
+                            ))
+                            if self._challenge_present() and not self.wait_for_cloudflare():
+                                raise RuntimeError("Cloudflare challenge not passed")
+                        log.info(f"Parsing specs from: {url}")
+                        with profiler.stage('parse'):
+                            results.append(self._extract_page_specs(url))
+                    except Exception as e:
+                        log.error(f"Failed to parse specs from {url}: {e}")
+                        results.append({})
+                
+                self._record_page_stats(f"batch of {len(batch)} pages", started)
+        finally:
+            for handle in handles[1:]:
+                try:
+                    self.driver.switch_to.window(handle)
+                    self.driver.close()
+                except Exception:
+                    pass
+            self.driver.switch_to.window(main_handle)
+        
+        return results
+    
+    @staticmethod
+    def soup_spec_text(html: str):
+        """(h1, весь текст страницы) из HTML."""
+        soup = BeautifulSoup(html, 'html.parser')
+        h1 = soup.find('h1')
+        return (h1.get_text(strip=True) if h1 else ''), soup.get_text()
+    
+    @staticmethod
+    def soup_spec_rows(html: str) -> Dict:
+        """То же, что возвращает _JS_SPEC_ROWS, но из HTML (архив страниц)."""
+        soup = BeautifulSoup(html, 'html.parser')
+        h1 = soup.find('h1')
+        rows = []
+        for tr in soup.select('table tr'):
+            if tr.find('table'):
+                continue   # layout-таблицы дублируют вложенный текст
+            cells = [_clean_text(c.get_text()) for c in tr.find_all(['td', 'th'], recursive=False)]
+            cells = [c for c in cells if c]
+            if cells:
+                rows.append(cells)
+        return {
+            'h1': _clean_text(h1.get_text()) if h1 else '',
+            'title': _clean_text(soup.title.get_text()) if soup.title else '',
+            'rows': rows,
+            'text': '' if rows or not soup.body else soup.body.get_text('\n'),
+        }
+    
+    @staticmethod
+    def spec_rows_text(data: Dict):
+        """(h1, текст для regex) из результата _JS_SPEC_ROWS / soup_spec_rows."""
+        h1_text = data.get('h1', '')
+        page_text = '\n'.join(
+            [data.get('title', ''), h1_text]
+            + [' '.join(row) for row in data.get('rows', [])]
+            + [data.get('text', '')]
+        )
+        return h1_text, page_text
+    
+    @staticmethod
+    def extract_specs(h1_text: str, page_text: str) -> Dict:
+        """Извлекает характеристики из заголовка и текста страницы."""
+        try:
             specs = {}
             
-            h1 = soup.find('h1')
-            if h1:
-                model_name = h1.get_text(strip=True)
+            if h1_text:
+                model_name = h1_text
                 model_name = re.sub(r'\s*specifications:.*', '', model_name, flags=re.IGNORECASE)
                 model_name = re.sub(r'\s*versions\s*&\s*types.*', '', model_name, flags=re.IGNORECASE)
                 model_name = re.sub(r'\s*data\s*and.*', '', model_name, flags=re.IGNORECASE)
                 specs['model'] = model_name.strip()
                 log.info(f"Model name: {specs['model']}")
             
-            page_text = soup.get_text()
-            
             # Парсинг характеристик (те же regex что и раньше)
             engine_patterns = [
                 (r'(\d+\.?\d*\s*(?:L|l)\s+(?:V\d+|inline|boxer|turbo|twin[\s-]?turbo|bi[\s-]?turbo|TFSI|TSI)?[\w\s-]*)', 'full'),
@@ -424,24 +1088,213 @@ class AutoCatalogScraper:
             return {}
     
     def close(self):
+        self._log_stats_summary()
         if self.driver:
-            try:
-                self.driver.quit()
-                log.info("Browser closed")
-            except:
-                pass
+            attached = self.attached
+            self._release_driver()
+            log.info("Detached from browser" if attached else "Browser closed")
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  КВОТЫ API (UNSPLASH / REMOVE.BG)
+# ═══════════════════════════════════════════════════════════════════════════
+def _int_header(headers, name: str) -> Optional[int]:
+    value = headers.get(name)
+    try:
+        return int(float(value)) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _retry_after(headers) -> Optional[float]:
+    """Retry-After: секунды или HTTP-дата → секунды ожидания."""
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class QuotaScheduler:
+    """
+    Планировщик вызовов лимитированного API + circuit breaker.
+
+    Читает X-Ratelimit-Remaining / X-Ratelimit-Reset / Retry-After и
+    равномерно распределяет остаток квоты до сброса окна. Ошибки квоты
+    (402/403/429, 401 — неверный ключ) и серии таймаутов размыкают цепь:
+    до её восстановления вызовы не выполняются, вызывающий код сразу
+    переходит к запасному варианту. Состояние хранится в QUOTA_STATE_FILE,
+    так что следующие запуски батча тоже не тратят время на заведомо
+    отклонённые запросы.
+    """
+
+    CREDIT_STATUSES = (401, 402, 403)   # Ключ / кредиты — сброс окна не поможет
+    RATE_STATUSES = (429,)              # Лимит частоты — ждём Retry-After / сброса окна
+    FAILURE_THRESHOLD = 3             # Подряд таймаутов/5xx до размыкания
+    COOLDOWN = 15 * 60                # Пауза, если сервер не сообщил время сброса
+    MAX_DEFER = 30                    # Дольше ждать интервал пейсинга нельзя — вызов пропускается
+
+    _FIELDS = ('remaining', 'reset_at', 'open_until', 'failures', 'last_call')
+
+    def __init__(self, name: str, window: float, state_file: Path = None):
+        self.name = name
+        self.window = window          # Длина окна квоты, сек
+        self.state_file = state_file or QUOTA_STATE_FILE
+        self.remaining = None
+        self.reset_at = 0.0
+        self.open_until = 0.0
+        self.failures = 0
+        self.last_call = 0.0
+        self._load()
+
+    # --- Состояние ---
+
+    def _read_all(self) -> Dict:
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _load(self):
+        state = self._read_all().get(self.name, {})
+        for field in self._FIELDS:
+            if field in state:
+                setattr(self, field, state[field])
+
+    def _save(self):
+        data = self._read_all()
+        data[self.name] = {field: getattr(self, field) for field in self._FIELDS}
+        tmp_path = self.state_file.with_name(self.state_file.name + '.tmp')
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_path, self.state_file)
+        except OSError as e:
+            log.debug(f"Could not save quota state: {e}")
+
+    def _trip(self, until: float, reason: str):
+        self.open_until = max(self.open_until, until)
+        log.warning(f"{self.name}: {reason} — circuit open for {int(self.open_until - time.time())}s, "
+                    f"further calls are skipped")
+        self._save()
+
+    # --- API ---
+
+    def acquire(self) -> bool:
+        """True — можно вызывать API (при необходимости после паузы), False — пропустить."""
+        now = time.time()
+        if now < self.open_until:
+            log.warning(f"{self.name}: circuit open ({int(self.open_until - now)}s left), skipping call")
+            return False
+
+        if self.reset_at and now >= self.reset_at:
+            # Окно квоты сброшено
+            self.remaining = None
+            self.reset_at = 0.0
+
+        if self.remaining is not None:
+            if self.remaining <= 0:
+                self._trip(self.reset_at or now + self.window, "quota exhausted")
+                return False
+            # Распределяем остаток квоты равномерно до конца окна: с таким
+            # интервалом квота не кончается раньше сброса
+            interval = ((self.reset_at or now + self.window) - now) / self.remaining
+            wait = self.last_call + interval - now
+            if wait > self.MAX_DEFER:
+                # Не блокируем процесс на долю окна: машина будет повторена позже
+                log.warning(f"{self.name}: next call allowed in {wait:.0f}s "
+                            f"({self.remaining} calls left), skipping call")
+                return False
+            if wait > 0:
+                log.info(f"{self.name}: pacing, waiting {wait:.1f}s ({self.remaining} calls left)")
+                time.sleep(wait)
+
+        self.last_call = time.time()
+        return True
+
+    def update(self, response: requests.Response):
+        """Обновляет квоту по заголовкам ответа, размыкает цепь при ошибке квоты."""
+        now = time.time()
+        headers = response.headers
+
+        remaining = _int_header(headers, 'X-Ratelimit-Remaining')
+        reset = _int_header(headers, 'X-Ratelimit-Reset')
+        if reset:
+            # Unix timestamp или секунды до сброса
+            self.reset_at = float(reset) if reset > 10 ** 9 else now + reset
+        if remaining is not None:
+            self.remaining = remaining
+            if not self.reset_at:
+                self.reset_at = now + self.window
+
+        status = response.status_code
+        if status in self.CREDIT_STATUSES:
+            # Кредиты кончились / ключ отклонён: заголовки частоты тут ни при чём
+            retry_after = _retry_after(headers) or 0
+            self._trip(now + max(self.COOLDOWN, retry_after), f"HTTP {status}")
+            return
+        if status in self.RATE_STATUSES:
+            retry_after = _retry_after(headers)
+            if retry_after is not None:
+                until = now + retry_after
+            elif self.reset_at > now:
+                until = self.reset_at
+            else:
+                until = now + self.COOLDOWN
+            self._trip(until, f"HTTP {status}")
+            return
+        if status >= 500:
+            self.record_failure(f"HTTP {status}")
+            return
+
+        self.failures = 0
+        self._save()
+
+    def record_failure(self, error):
+        """Таймаут / обрыв соединения / 5xx. После серии ошибок цепь размыкается."""
+        self.failures += 1
+        log.warning(f"{self.name}: call failed ({error}), {self.failures}/{self.FAILURE_THRESHOLD}")
+        if self.failures >= self.FAILURE_THRESHOLD:
+            self.failures = 0
+            self._trip(time.time() + self.COOLDOWN, "repeated failures")
+        else:
+            self._save()
 
 
 # ═══════════════════════════════════════════════════════════════════════════
 #  ПОЛУЧЕНИЕ ФОТО
 # ═══════════════════════════════════════════════════════════════════════════
 class ImageFetcher:
+    def __init__(self):
+        # Unsplash: почасовой лимит; remove.bg: лимит в минуту + кредиты
+        self.unsplash = QuotaScheduler("unsplash", window=3600)
+        self.removebg = QuotaScheduler("remove.bg", window=60)
+        # True — последний get() не удался из-за сбоя / квоты API (фото нет
+        # или фон не удалён) и его стоит повторить позже
+        self.degraded = False
+    
     def get(self, brand: str, model: str) -> Optional[Image.Image]:
+        self.degraded = False
+        with profiler.stage('image_fetch'):
+            return self._get(brand, model)
+    
+    def _get(self, brand: str, model: str) -> Optional[Image.Image]:
         try:
             if not UNSPLASH_ACCESS_KEY:
                 log.warning("No Unsplash API key")
                 return None
             
+            if not self.unsplash.acquire():
+                self.degraded = True
+                return None
+            
             query = f"{brand} {model} car".strip()
             log.info(f"Fetching image from Unsplash: {query}")
             
@@ -449,10 +1302,18 @@ class ImageFetcher:
             params = {'query': query, 'per_page': 1, 'orientation': 'landscape'}
             headers = {'Authorization': f'Client-ID {UNSPLASH_ACCESS_KEY}'}
             
-            response = requests.get(search_url, params=params, headers=headers, timeout=10)
+            try:
+                response = requests.get(search_url, params=params, headers=headers, timeout=10)
+            except requests.RequestException as e:
+                self.unsplash.record_failure(e)
+                raise
+            self.unsplash.update(response)
             
             if response.status_code == 200:
                 data = response.json()
+                if not data.get('results'):
+                    log.warning(f"No photos on Unsplash for: {query}")
+                    return None
                 if data.get('results') and len(data['results']) > 0:
                     photo_url = data['results'][0]['urls']['regular']
                     log.info(f"Found image: {photo_url}")
@@ -465,46 +1326,89 @@ class ImageFetcher:
                         # ВСЕГДА вызываем remove.bg!
                         return self.remove_background(img)
                     
+            self.degraded = True
             log.warning("Could not fetch image from Unsplash")
             return None
             
         except Exception as e:
+            self.degraded = True
             log.error(f"Image fetch error: {e}")
             return None
     
+    @staticmethod
+    def cache_key(brand: str, model: str) -> str:
+        return hashlib.sha1(normalize_key(f"{brand} {model}").encode()).hexdigest()[:16]
+    
+    def save_to_cache(self, key: str, img: Image.Image):
+        """Сохраняет готовое (уже без фона) фото — повторно API не вызываются."""
+        PHOTO_CACHE_DIR.mkdir(exist_ok=True)
+        img.save(PHOTO_CACHE_DIR / f"{key}.png")
+    
+    def load_from_cache(self, key: str) -> Optional[Image.Image]:
+        path = PHOTO_CACHE_DIR / f"{key}.png"
+        if not path.exists():
+            return None
+        try:
+            with profiler.stage('image_fetch'):
+                img = Image.open(path)
+                img.load()
+            log.info(f"Using cached photo: {path}")
+            return img
+        except Exception as e:
+            log.warning(f"Could not load cached photo {path}: {e}")
+            return None
+    
     def remove_background(self, img: Image.Image) -> Image.Image:
         """Удаление фона через remove.bg API."""
+        with profiler.stage('bg_removal'):
+            return self._remove_background(img)
+    
+    def _remove_background(self, img: Image.Image) -> Image.Image:
         try:
             if not REMOVEBG_API_KEY:
                 log.warning("No remove.bg API key, using original image")
                 return img.convert("RGBA")
             
+            if not self.removebg.acquire():
+                self.degraded = True
+                log.warning("Using original image without background removal")
+                return img.convert("RGBA")
+            
             log.info("Removing background via remove.bg API...")
             
             buffer = io.BytesIO()
             img.save(buffer, format='PNG')
             buffer.seek(0)
             
-            response = requests.post(
-                'https://api.remove.bg/v1.0/removebg',
-                files={'image_file': buffer},
-                data={'size': 'auto'},
-                headers={'X-Api-Key': REMOVEBG_API_KEY},
-                timeout=30
-            )
+            try:
+                response = requests.post(
+                    'https://api.remove.bg/v1.0/removebg',
+                    files={'image_file': buffer},
+                    data={'size': 'auto'},
+                    headers={'X-Api-Key': REMOVEBG_API_KEY},
+                    timeout=30
+                )
+            except requests.RequestException as e:
+                self.removebg.record_failure(e)
+                raise
+            self.removebg.update(response)
             
             if response.status_code == 200:
                 log.info("Background removed successfully!")
                 return Image.open(io.BytesIO(response.content)).convert("RGBA")
             else:
                 log.warning(f"Remove.bg failed with status {response.status_code}")
-                if response.status_code == 403:
+                if response.status_code == 402:
+                    log.warning("Insufficient remove.bg credits")
+                elif response.status_code == 403:
                     log.warning("API key may be invalid or credits exhausted")
                 log.warning(f"Response: {response.text[:200]}")  # Первые 200 символов
                 log.warning("Using original image without background removal")
+                self.degraded = True
                 return img.convert("RGBA")
                 
         except Exception as e:
+            self.degraded = True
             log.error(f"Background removal error: {e}")
             log.warning("Using original image without background removal")
             return img.convert("RGBA") if img.mode != 'RGBA' else img
@@ -513,7 +1417,140 @@ class ImageFetcher:
 # ═══════════════════════════════════════════════════════════════════════════
 #  ГЕНЕРАЦИЯ ПОСТЕРА (PIXEL-PERFECT ПО РЕФЕРЕНСУ!)
 # ═══════════════════════════════════════════════════════════════════════════
+class _DrawRecorder:
+    """
+    Записывает вызовы ImageDraw (text/rectangle/line/ellipse) в координатах
+    итогового постера, чтобы воспроизвести их на любом канвасе или полосе.
+    """
+
+    def __init__(self):
+        self.ops = []
+
+    def text(self, xy, text, **kwargs):
+        self.ops.append(('text', (xy, text), kwargs))
+
+    def rectangle(self, xy, **kwargs):
+        self.ops.append(('rectangle', (xy,), kwargs))
+
+    def line(self, xy, **kwargs):
+        self.ops.append(('line', (xy,), kwargs))
+
+    def ellipse(self, xy, **kwargs):
+        self.ops.append(('ellipse', (xy,), kwargs))
+
+    def photo(self, box):
+        """Маркер вставки фото (x, y, w, h) — сохраняет порядок слоёв."""
+        self.ops.append(('photo', (box,), {}))
+
+    @staticmethod
+    def _span(name, args, kwargs):
+        """Вертикальный диапазон (top, bottom), который затрагивает операция."""
+        if name == 'photo':
+            _, y, _, h = args[0]
+            return y, y + h
+        if name == 'text':
+            (_, y), text = args
+            bbox = kwargs['font'].getbbox(text)
+            return y + bbox[1], y + bbox[3]
+        ys = [p[1] for p in args[0]]
+        pad = kwargs.get('width', 1)
+        return min(ys) - pad, max(ys) + pad
+
+    def replay(self, draw, paste_photo, y0: int = 0, y1: Optional[int] = None):
+        """Рисует операции, пересекающие строки [y0, y1), со сдвигом на -y0."""
+        for name, args, kwargs in self.ops:
+            if y1 is not None:
+                top, bottom = self._span(name, args, kwargs)
+                if bottom < y0 or top >= y1:
+                    continue
+            if name == 'photo':
+                paste_photo(args[0])
+                continue
+            xy = args[0]
+            if isinstance(xy[0], (tuple, list)):
+                xy = [(x, y - y0) for x, y in xy]
+            else:
+                xy = (xy[0], xy[1] - y0)
+            getattr(draw, name)(xy, *args[1:], **kwargs)
+
+
+class PNGStripWriter:
+    """
+    Потоковый PNG энкодер (RGB, 8 бит): принимает полосы сверху вниз и
+    сразу сжимает их в IDAT — весь кадр никогда не лежит в памяти.
+    Пишет во временный файл и атомарно переименовывает при закрытии.
+    """
+
+    SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+    def __init__(self, path: str, width: int, height: int,
+                 text: Optional[Dict[str, str]] = None, dpi: Optional[int] = None,
+                 compress_level: int = 6):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(self.path.name + '.part')
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self._z = zlib.compressobj(compress_level)
+        self._f = open(self.tmp_path, 'wb')
+        self._f.write(self.SIGNATURE)
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        if dpi:
+            ppm = int(round(dpi / 0.0254))
+            self._chunk(b'pHYs', struct.pack('>IIB', ppm, ppm, 1))
+        for key, value in (text or {}).items():
+            self._chunk(b'tEXt', key.encode('latin-1') + b'\0' + value.encode('latin-1'))
+
+    def _chunk(self, kind: bytes, data: bytes):
+        self._f.write(struct.pack('>I', len(data)))
+        self._f.write(kind)
+        self._f.write(data)
+        self._f.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def write_strip(self, strip: Image.Image):
+        if strip.mode != 'RGB' or strip.width != self.width:
+            raise ValueError(f"Expected RGB strip {self.width}px wide, got {strip.mode} {strip.width}px")
+        raw = strip.tobytes()
+        stride = self.width * 3
+        rows = bytearray()
+        for offset in range(0, len(raw), stride):
+            rows += b'\0'                       # Filter type 0 (None)
+            rows += raw[offset:offset + stride]
+        data = self._z.compress(bytes(rows))
+        if data:
+            self._chunk(b'IDAT', data)
+        self.rows_written += strip.height
+
+    def close(self):
+        if self._f.closed:
+            return
+        if self.rows_written != self.height:
+            self.abort()
+            raise ValueError(f"PNG incomplete: {self.rows_written}/{self.height} rows written")
+        self._chunk(b'IDAT', self._z.flush())
+        self._chunk(b'IEND', b'')
+        self._f.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self._f.close()
+        if self.tmp_path.exists():
+            self.tmp_path.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
 class PosterGenerator:
+    # Все размеры ниже — в канвас-единицах: сетка референса 800x1200.
+    # В пиксели переводятся через self.u() с учётом масштаба (scale).
+    
     # Canvas размеры
     WIDTH = 800
     HEIGHT = 1200
@@ -543,9 +1580,80 @@ class PosterGenerator:
     FLAG_WIDTH = 50
     FLAG_HEIGHT = 35
     
-    def __init__(self):
+    # Печать: 300 dpi → 7200x10800, рендер полосами по STRIP_HEIGHT строк
+    PRINT_SCALE = 9
+    PRINT_DPI = 300
+    STRIP_HEIGHT = 256
+    
+    # Версия шаблона — увеличивать при ЛЮБОМ изменении вёрстки,
+    # иначе уже отрендеренные постеры не будут перегенерированы
+    TEMPLATE_VERSION = "5.1"
+    FINGERPRINT_KEY = "poster-fingerprint"
+    
+    def __init__(self, scale: float = 1.0, strip_height: int = 0, dpi: Optional[int] = None):
         self.font_path_bold = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
         self.font_path_regular = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+        self.scale = scale
+        self.strip_height = strip_height  # > 0 — потоковый рендер полосами (только PNG)
+        self.dpi = dpi
+        self.width = self.u(self.WIDTH)
+        self.height = self.u(self.HEIGHT)
+    
+    @classmethod
+    def for_print(cls) -> "PosterGenerator":
+        """Генератор для печати: 300 dpi, ограниченное потребление памяти."""
+        return cls(scale=cls.PRINT_SCALE, strip_height=cls.STRIP_HEIGHT, dpi=cls.PRINT_DPI)
+    
+    def u(self, value: float) -> int:
+        """Канвас-единицы → пиксели."""
+        return int(round(value * self.scale))
+    
+    def load_font(self, font_path: str, size: float):
+        """Шрифт размера size (в канвас-единицах)."""
+        try:
+            return ImageFont.truetype(font_path, self.u(size))
+        except:
+            return ImageFont.load_default()
+    
+    def fingerprint(self, specs: Dict, photo: Optional[Image.Image]) -> str:
+        """Хэш всех входов рендера: характеристики + фото + версия шаблона."""
+        h = hashlib.sha256()
+        h.update(f"{self.TEMPLATE_VERSION}|{self.width}x{self.height}|{self.dpi}|".encode())
+        h.update(json.dumps(specs, sort_keys=True, ensure_ascii=False, default=str).encode())
+        if photo is not None:
+            h.update(f"|{photo.mode}|{photo.width}x{photo.height}|".encode())
+            h.update(hashlib.sha256(photo.tobytes()).digest())
+        return h.hexdigest()
+    
+    def _sidecar_path(self, output: str) -> Path:
+        path = Path(output)
+        return path.with_name(path.name + '.fingerprint')
+    
+    def read_fingerprint(self, output: str) -> str:
+        """Fingerprint уже сохранённого постера (PNG text chunk или sidecar файл)."""
+        path = Path(output)
+        if not path.exists():
+            return ''
+        try:
+            if path.suffix.lower() == '.png':
+                # Text chunk пишется перед IDAT — пиксели не декодируются
+                with Image.open(path) as existing:
+                    return existing.info.get(self.FINGERPRINT_KEY, '')
+            sidecar = self._sidecar_path(output)
+            return sidecar.read_text().strip() if sidecar.exists() else ''
+        except Exception as e:
+            log.debug(f"Could not read fingerprint of {output}: {e}")
+            return ''
+    
+    def save(self, canvas: Image.Image, output: str, fingerprint: str):
+        """Кодирует постер и сохраняет рядом его fingerprint."""
+        if Path(output).suffix.lower() == '.png':
+            info = PngInfo()
+            info.add_text(self.FINGERPRINT_KEY, fingerprint)
+            canvas.save(output, pnginfo=info)
+        else:
+            canvas.save(output)
+            self._sidecar_path(output).write_text(fingerprint)
     
     def draw_text_with_tracking(self, draw, text: str, x: int, y: int, 
                                 font, color, tracking: int = 0):
@@ -560,29 +1668,34 @@ class PosterGenerator:
     
     def auto_fit_text(self, draw, text: str, font_path: str, 
                      max_width: int, start_size: int) -> ImageFont.FreeTypeFont:
-        """Автоматически подбирает размер шрифта чтобы текст влез."""
-        size = start_size
-        while size > 20:  # Минимальный размер 20px
+        """
+        Автоматически подбирает размер шрифта чтобы текст влез.
+        start_size — в канвас-единицах, max_width — в пикселях.
+        """
+        size = self.u(start_size)
+        min_size = self.u(20)             # Минимальный размер 20 единиц
+        step = max(2, self.u(2))
+        while size > min_size:
             try:
                 font = ImageFont.truetype(font_path, size)
                 bbox = font.getbbox(text)
                 width = bbox[2] - bbox[0]
                 if width <= max_width:
                     return font
-                size -= 2
+                size -= step
             except:
                 return ImageFont.load_default()
         try:
-            return ImageFont.truetype(font_path, 20)
+            return ImageFont.truetype(font_path, min_size)
         except:
             return ImageFont.load_default()
     
     def draw_flag(self, draw, country: str, x: int, y: int):
         """Рисует флаг страны с рамкой."""
-        w, h = self.FLAG_WIDTH, self.FLAG_HEIGHT
+        w, h = self.u(self.FLAG_WIDTH), self.u(self.FLAG_HEIGHT)
         
         # Рамка
-        draw.rectangle([(x, y), (x + w, y + h)], outline=self.FLAG_BORDER, width=1)
+        draw.rectangle([(x, y), (x + w, y + h)], outline=self.FLAG_BORDER, width=max(1, self.u(1)))
         
         if country == "GERMANY":
             # Немецкий: черный-красный-золотой (горизонтальные полосы)
@@ -657,274 +1770,1398 @@ class PosterGenerator:
                 (x + w, y + h // 2 + cross_w_red // 2)
             ], fill=(200, 16, 46))
     
-    def generate(self, specs: Dict, photo: Optional[Image.Image], output: str):
-        """Генерирует постер с pixel-perfect дизайном по референсу."""
+    def generate(self, specs, photo: Optional[Image.Image], output: str,
+                 force: bool = False):
+        """Генерирует постер с pixel-perfect дизайном по референсу. True — постер готов."""
+        if isinstance(specs, SpecRecord):
+            specs = specs.to_specs()
+        return self._generate(lambda: self.compose(specs, photo), specs, photo, output, force)
+    
+    def generate_comparison(self, family: str, variants: List[Dict], photo: Optional[Image.Image],
+                            output: str, force: bool = False):
+        """
+        Постер-сравнение всех версий модели: общая шапка + таблица характеристик.
+        Больше COMPARISON_SHEET_ROWS версий — несколько листов (<output>_sheetN).
+        """
+        per_sheet = self.COMPARISON_SHEET_ROWS
+        sheets = [variants[i:i + per_sheet] for i in range(0, len(variants), per_sheet)] or [[]]
+        if len(sheets) == 1:
+            return self._generate(lambda: self.compose_comparison(family, variants, photo),
+                                  {'family': family, 'variants': variants}, photo, output, force)
+        
+        log.info(f"{len(variants)} variants: splitting comparison into {len(sheets)} sheets")
+        path = Path(output)
+        ok = True
+        for n, sheet in enumerate(sheets, 1):
+            note = f"Sheet {n}/{len(sheets)}"
+            sheet_output = str(path.with_name(f"{path.stem}_sheet{n}{path.suffix}"))
+            ok = self._generate(lambda: self.compose_comparison(family, sheet, photo, note),
+                                {'family': family, 'variants': sheet, 'note': note},
+                                photo, sheet_output, force) and ok
+        return ok
+    
+    def _generate(self, compose, fingerprint_data: Dict, photo: Optional[Image.Image],
+                  output: str, force: bool) -> bool:
         try:
-            log.info("Generating poster...")
-            
-            # Canvas
-            canvas = Image.new('RGB', (self.WIDTH, self.HEIGHT), 'white')
-            draw = ImageDraw.Draw(canvas)
-            
-            # ============ 1. ВЕРХНИЙ БЛОК: БРЕНД И МОДЕЛЬ ============
-            
-            # Парсим название
-            model_full = specs.get('model', 'CAR MODEL')
-            parts = model_full.split()
-            brand = parts[0].upper() if parts else 'BRAND'
-            model = ' '.join(parts[1:]).upper() if len(parts) > 1 else 'MODEL'
-            
-            # Шрифт для бренда — средний серый, как в референсе
-            try:
-                font_brand = ImageFont.truetype(self.font_path_bold, 80)
-            except:
-                font_brand = ImageFont.load_default()
-            
-            # Рисуем бренд с tracking +4px
-            brand_y = self.TOP_OFFSET
-            brand_end_x = self.draw_text_with_tracking(
-                draw, brand, self.MARGIN_LEFT, brand_y,
-                font_brand, self.BRAND_COLOR, tracking=4
-            )
-            brand_height = font_brand.getbbox(brand)[3] - font_brand.getbbox(brand)[1]
-            
-            # Шрифт для модели (auto-fit если длинная) — крупнее бренда, черный
-            model_y = brand_y + brand_height + self.BRAND_MODEL_GAP
-            max_model_width = self.WIDTH - self.MARGIN_LEFT * 2
-            font_model = self.auto_fit_text(
-                draw, model, self.font_path_bold, max_model_width, 72
-            )
-            draw.text((self.MARGIN_LEFT, model_y), model, fill=self.TEXT_COLOR, font=font_model)
-            model_height = font_model.getbbox(model)[3] - font_model.getbbox(model)[1]
-            
-            # ============ 2. СЕРЫЙ БЛОК + ФОТО МАШИНЫ ============
-            
-            # Серый блок начинается сразу после заголовка с небольшим отступом
-            car_bg_top_gap = 30
-            car_bg_y = model_y + model_height + car_bg_top_gap
-            
-            # Блок — полная ширина (как в референсе)
-            car_bg_width = self.WIDTH
-            car_bg_height = int(self.HEIGHT * self.CAR_BG_HEIGHT_PERCENT)
-            car_bg_x = 0
-            
-            # Рисуем серый блок
-            draw.rectangle([
-                (car_bg_x, car_bg_y),
-                (car_bg_x + car_bg_width, car_bg_y + car_bg_height)
-            ], fill=self.CAR_BG_COLOR)
-            
-            # Вставляем фото машины (если есть)
-            if photo:
-                # Внутренний отступ 5% с каждой стороны
-                inner_pad_x = int(car_bg_width * 0.05)
-                inner_pad_y = int(car_bg_height * 0.05)
-                max_photo_width  = car_bg_width  - 2 * inner_pad_x
-                max_photo_height = car_bg_height - 2 * inner_pad_y
-                
-                # Resize с сохранением пропорций
-                photo.thumbnail((max_photo_width, max_photo_height), Image.Resampling.LANCZOS)
+            # Входы не изменились — пропускаем рендер и кодирование
+            fingerprint = self.fingerprint(fingerprint_data, photo)
+            if not force and self.read_fingerprint(output) == fingerprint:
+                log.info(f"Poster is up to date, skipping render: {output}")
+                return True
+            
+            if self.strip_height and Path(output).suffix.lower() != '.png':
+                log.error(f"Strip rendering supports PNG output only: {output}")
+                return False
+            
+            log.info(f"Generating poster ({self.width}x{self.height})...")
+            with profiler.stage('render'):
+                layout = compose()
                 
-                # Центрируем фото внутри серого блока
-                photo_x = car_bg_x + (car_bg_width  - photo.width)  // 2
-                photo_y = car_bg_y + (car_bg_height - photo.height) // 2
-                
-                if photo.mode == 'RGBA':
-                    canvas.paste(photo, (photo_x, photo_y), photo)
+                if self.strip_height:
+                    self.render_strips(layout, photo, output, fingerprint)
                 else:
-                    canvas.paste(photo, (photo_x, photo_y))
-            
-            # ============ 3. НИЖНИЙ БЛОК: ГОД + ХАРАКТЕРИСТИКИ ============
-            
-            # Старт характеристик — фиксированный отступ от нижнего края серого блока
-            specs_gap = 55
-            specs_start_y = car_bg_y + car_bg_height + specs_gap
-            
-            # Шрифты — соответствуют референсу (небольшие, чёткие)
-            try:
-                font_year_label = ImageFont.truetype(self.font_path_bold, 26)
-                font_year_value = ImageFont.truetype(self.font_path_regular, 18)
-                font_spec_label = ImageFont.truetype(self.font_path_bold, 20)
-                font_spec_value = ImageFont.truetype(self.font_path_regular, 20)
-            except:
-                font_year_label = font_year_value = ImageFont.load_default()
-                font_spec_label = font_spec_value = ImageFont.load_default()
-            
-            # --- Колонка ГОД (крайняя левая) ---
-            year = specs.get('year', 'N/A')
-            year_col_x = self.MARGIN_LEFT
-            
-            draw.text((year_col_x, specs_start_y), "YEAR", fill=self.TEXT_COLOR, font=font_year_label)
-            draw.text((year_col_x, specs_start_y + 32), year, fill=self.TEXT_COLOR, font=font_year_value)
-            
-            # Вертикальная разделительная линия
-            divider_x = year_col_x + 145          # Фиксированная позиция, не зависит от шрифта
-            divider_y_start = specs_start_y - 5
-            divider_y_end   = specs_start_y + 4 * self.LINE_HEIGHT + 10
-            draw.line(
-                [(divider_x, divider_y_start), (divider_x, divider_y_end)],
-                fill=self.LINE_COLOR, width=2
-            )
+                    canvas = self.render_canvas(layout, photo)
             
-            # --- Левая колонка характеристик ---
-            left_specs = [
-                ("Engine", specs.get('engine', 'N/A')),
-                ("Power",  specs.get('power',  'N/A')),
-                ("Torque", specs.get('torque', 'N/A')),
-                ("Weight", specs.get('weight', 'N/A')),
-            ]
-            left_col_label_x = divider_x + self.DIVIDER_OFFSET
-            max_left_label_w = max(
-                font_spec_label.getbbox(lbl)[2] - font_spec_label.getbbox(lbl)[0]
-                for lbl, _ in left_specs
-            )
-            left_col_value_x = left_col_label_x + max_left_label_w + self.COLUMN_GAP
-
-            # --- Правая колонка — вычисляем СНАЧАЛА, начиная с правого края ---
-            right_specs = [
-                ("0-100 km/h", specs.get('acceleration', 'N/A')),
-                ("Top speed",  specs.get('top_speed',    'N/A')),
-            ]
-            max_right_label_w = max(
-                font_spec_label.getbbox(lbl)[2] - font_spec_label.getbbox(lbl)[0]
-                for lbl, _ in right_specs
-            )
-            max_right_value_w = max(
-                font_spec_value.getbbox(val)[2] - font_spec_value.getbbox(val)[0]
-                for _, val in right_specs
-            )
-
-            FLAG_W = 50
-            FLAG_H = 35
-            FLAG_MARGIN = 14
-
-            # Anchor: flag right edge at canvas_right - 10px
-            flag_right  = self.WIDTH - 10
-            flag_x_base = flag_right - FLAG_W
-            right_col_value_x = flag_x_base - FLAG_MARGIN - max_right_value_w
-            right_col_label_x = right_col_value_x - self.COLUMN_GAP - max_right_label_w
-
-            # Max width for left column values = gap to right label minus padding
-            left_value_max_w = right_col_label_x - left_col_value_x - 35
-
-            def truncate_text(text, font, max_w):
-                """Truncate text with ellipsis if too wide."""
-                if max_w <= 0:
-                    return ''
-                if font.getbbox(text)[2] - font.getbbox(text)[0] <= max_w:
-                    return text
-                while len(text) > 1:
-                    text = text[:-1]
-                    candidate = text + '…'
-                    if font.getbbox(candidate)[2] - font.getbbox(candidate)[0] <= max_w:
-                        return candidate
-                return text
-
-            for i, (label, value) in enumerate(left_specs):
-                y = specs_start_y + i * self.LINE_HEIGHT
-                draw.text((left_col_label_x, y), label, fill=self.TEXT_COLOR, font=font_spec_label)
-                display_value = truncate_text(value, font_spec_value, left_value_max_w)
-                draw.text((left_col_value_x, y), display_value, fill=self.TEXT_COLOR, font=font_spec_value)
-
-            for i, (label, value) in enumerate(right_specs):
-                y = specs_start_y + i * self.LINE_HEIGHT
-                draw.text((right_col_label_x, y), label, fill=self.TEXT_COLOR, font=font_spec_label)
-                draw.text((right_col_value_x,  y), value, fill=self.TEXT_COLOR, font=font_spec_value)
-            
-            # ============ 4. ФЛАГ СТРАНЫ ============
-            
-            country = specs.get('country', '')
-            if country:
-                # Флаг — позиция уже вычислена выше как flag_x_base
-                flag_y = specs_start_y + self.LINE_HEIGHT + 4
-                self.draw_flag(draw, country, flag_x_base, flag_y)
-            
-            # ============ СОХРАНЕНИЕ ============
-            
-            canvas.save(output)
+            if not self.strip_height:
+                with profiler.stage('encode'):
+                    self.save(canvas, output, fingerprint)
             log.info(f"Poster saved: {output}")
+            return True
             
         except Exception as e:
             log.error(f"Poster generation failed: {e}")
             import traceback
             traceback.print_exc()
+            return False
+    
+    def _fit_photo(self, photo: Image.Image, max_w: int, max_h: int):
+        """Размер фото, вписанного в блок (увеличение — не больше масштаба постера)."""
+        ratio = min(max_w / photo.width, max_h / photo.height, self.scale)
+        return max(1, int(photo.width * ratio)), max(1, int(photo.height * ratio))
+    
+    def render_canvas(self, layout: _DrawRecorder, photo: Optional[Image.Image]) -> Image.Image:
+        """Рендер всего постера в один канвас (превью / веб)."""
+        canvas = Image.new('RGB', (self.width, self.height), 'white')
+        draw = ImageDraw.Draw(canvas)
+        
+        def paste_photo(box):
+            x, y, w, h = box
+            fitted = photo if photo.size == (w, h) else photo.resize((w, h), Image.Resampling.LANCZOS)
+            if fitted.mode == 'RGBA':
+                canvas.paste(fitted, (x, y), fitted)
+            else:
+                canvas.paste(fitted, (x, y))
+        
+        layout.replay(draw, paste_photo)
+        return canvas
+    
+    def render_strips(self, layout: _DrawRecorder, photo: Optional[Image.Image],
+                      output: str, fingerprint: str):
+        """
+        Рендер полосами по strip_height строк прямо в PNG энкодер.
+        В памяти одновременно только одна полоса и соответствующий ей
+        фрагмент фото — пиковый RSS не зависит от размера постера.
+        """
+        text = {self.FINGERPRINT_KEY: fingerprint}
+        with PNGStripWriter(output, self.width, self.height, text=text, dpi=self.dpi) as writer:
+            for y0 in range(0, self.height, self.strip_height):
+                y1 = min(y0 + self.strip_height, self.height)
+                strip = Image.new('RGB', (self.width, y1 - y0), 'white')
+                draw = ImageDraw.Draw(strip)
+                
+                def paste_photo(box):
+                    x, y, w, h = box
+                    top, bottom = max(y, y0), min(y + h, y1)
+                    if top >= bottom:
+                        return
+                    # Ресэмплим только строки фото, попадающие в полосу
+                    sy = photo.height / h
+                    band = photo.resize(
+                        (w, bottom - top), Image.Resampling.LANCZOS,
+                        box=(0, (top - y) * sy, photo.width, (bottom - y) * sy),
+                    )
+                    if band.mode == 'RGBA':
+                        strip.paste(band, (x, top - y0), band)
+                    else:
+                        strip.paste(band, (x, top - y0))
+                
+                layout.replay(draw, paste_photo, y0, y1)
+                with profiler.stage('encode', trace_memory=False):
+                    writer.write_strip(strip)
+    
+    def truncate_text(self, text: str, font, max_w: int) -> str:
+        """Truncate text with ellipsis if too wide."""
+        if max_w <= 0:
+            return ''
+        if font.getbbox(text)[2] - font.getbbox(text)[0] <= max_w:
+            return text
+        while len(text) > 1:
+            text = text[:-1]
+            candidate = text + '…'
+            if font.getbbox(candidate)[2] - font.getbbox(candidate)[0] <= max_w:
+                return candidate
+        return text
+    
+    def _compose_header(self, draw, model_full: str) -> int:
+        """Бренд + модель. Возвращает нижнюю границу заголовка (px)."""
+        u = self.u
+        
+        # Парсим название
+        parts = model_full.split()
+        brand = parts[0].upper() if parts else 'BRAND'
+        model = ' '.join(parts[1:]).upper() if len(parts) > 1 else 'MODEL'
+        
+        # Шрифт для бренда — средний серый, как в референсе
+        font_brand = self.load_font(self.font_path_bold, 80)
+        
+        # Рисуем бренд с tracking +4
+        brand_y = u(self.TOP_OFFSET)
+        margin_left = u(self.MARGIN_LEFT)
+        self.draw_text_with_tracking(
+            draw, brand, margin_left, brand_y,
+            font_brand, self.BRAND_COLOR, tracking=u(4)
+        )
+        brand_height = font_brand.getbbox(brand)[3] - font_brand.getbbox(brand)[1]
+        
+        # Шрифт для модели (auto-fit если длинная) — крупнее бренда, черный
+        model_y = brand_y + brand_height + u(self.BRAND_MODEL_GAP)
+        max_model_width = self.width - margin_left * 2
+        font_model = self.auto_fit_text(
+            draw, model, self.font_path_bold, max_model_width, 72
+        )
+        draw.text((margin_left, model_y), model, fill=self.TEXT_COLOR, font=font_model)
+        model_height = font_model.getbbox(model)[3] - font_model.getbbox(model)[1]
+        return model_y + model_height
+    
+    def _compose_car_block(self, draw, photo: Optional[Image.Image], car_bg_y: int,
+                           car_bg_height: int):
+        """Серый блок на всю ширину с вписанным по центру фото."""
+        car_bg_width = self.width
+        car_bg_x = 0
+        
+        # Рисуем серый блок
+        draw.rectangle([
+            (car_bg_x, car_bg_y),
+            (car_bg_x + car_bg_width, car_bg_y + car_bg_height)
+        ], fill=self.CAR_BG_COLOR)
+        
+        # Вставляем фото машины (если есть)
+        if photo:
+            # Внутренний отступ 5% с каждой стороны
+            inner_pad_x = int(car_bg_width * 0.05)
+            inner_pad_y = int(car_bg_height * 0.05)
+            max_photo_width  = car_bg_width  - 2 * inner_pad_x
+            max_photo_height = car_bg_height - 2 * inner_pad_y
+            
+            # Resize с сохранением пропорций — выполняется при рендере
+            photo_w, photo_h = self._fit_photo(photo, max_photo_width, max_photo_height)
+            
+            # Центрируем фото внутри серого блока
+            photo_x = car_bg_x + (car_bg_width  - photo_w) // 2
+            photo_y = car_bg_y + (car_bg_height - photo_h) // 2
+            draw.photo((photo_x, photo_y, photo_w, photo_h))
+    
+    def compose(self, specs: Dict, photo: Optional[Image.Image]) -> _DrawRecorder:
+        """Вёрстка постера: все операции рисования в пикселях текущего масштаба."""
+        u = self.u
+        draw = _DrawRecorder()
+        margin_left = u(self.MARGIN_LEFT)
+        
+        # ============ 1. ВЕРХНИЙ БЛОК: БРЕНД И МОДЕЛЬ ============
+        
+        header_bottom = self._compose_header(draw, specs.get('model', 'CAR MODEL'))
+        
+        # ============ 2. СЕРЫЙ БЛОК + ФОТО МАШИНЫ ============
+        
+        # Серый блок начинается сразу после заголовка с небольшим отступом
+        car_bg_top_gap = u(30)
+        car_bg_y = header_bottom + car_bg_top_gap
+        car_bg_height = int(self.height * self.CAR_BG_HEIGHT_PERCENT)
+        self._compose_car_block(draw, photo, car_bg_y, car_bg_height)
+        
+        # ============ 3. НИЖНИЙ БЛОК: ГОД + ХАРАКТЕРИСТИКИ ============
+        
+        # Старт характеристик — фиксированный отступ от нижнего края серого блока
+        specs_gap = u(55)
+        specs_start_y = car_bg_y + car_bg_height + specs_gap
+        line_height = u(self.LINE_HEIGHT)
+        column_gap = u(self.COLUMN_GAP)
+        
+        # Шрифты — соответствуют референсу (небольшие, чёткие)
+        font_year_label = self.load_font(self.font_path_bold, 26)
+        font_year_value = self.load_font(self.font_path_regular, 18)
+        font_spec_label = self.load_font(self.font_path_bold, 20)
+        font_spec_value = self.load_font(self.font_path_regular, 20)
+        
+        # --- Колонка ГОД (крайняя левая) ---
+        year = specs.get('year', 'N/A')
+        year_col_x = margin_left
+        
+        draw.text((year_col_x, specs_start_y), "YEAR", fill=self.TEXT_COLOR, font=font_year_label)
+        draw.text((year_col_x, specs_start_y + u(32)), year, fill=self.TEXT_COLOR, font=font_year_value)
+        
+        # Вертикальная разделительная линия
+        divider_x = year_col_x + u(145)       # Фиксированная позиция, не зависит от шрифта
+        divider_y_start = specs_start_y - u(5)
+        divider_y_end   = specs_start_y + 4 * line_height + u(10)
+        draw.line(
+            [(divider_x, divider_y_start), (divider_x, divider_y_end)],
+            fill=self.LINE_COLOR, width=u(2)
+        )
+        
+        # --- Левая колонка характеристик ---
+        left_specs = [
+            ("Engine", specs.get('engine', 'N/A')),
+            ("Power",  specs.get('power',  'N/A')),
+            ("Torque", specs.get('torque', 'N/A')),
+            ("Weight", specs.get('weight', 'N/A')),
+        ]
+        left_col_label_x = divider_x + u(self.DIVIDER_OFFSET)
+        max_left_label_w = max(
+            font_spec_label.getbbox(lbl)[2] - font_spec_label.getbbox(lbl)[0]
+            for lbl, _ in left_specs
+        )
+        left_col_value_x = left_col_label_x + max_left_label_w + column_gap
+
+        # --- Правая колонка — вычисляем СНАЧАЛА, начиная с правого края ---
+        right_specs = [
+            ("0-100 km/h", specs.get('acceleration', 'N/A')),
+            ("Top speed",  specs.get('top_speed',    'N/A')),
+        ]
+        max_right_label_w = max(
+            font_spec_label.getbbox(lbl)[2] - font_spec_label.getbbox(lbl)[0]
+            for lbl, _ in right_specs
+        )
+        max_right_value_w = max(
+            font_spec_value.getbbox(val)[2] - font_spec_value.getbbox(val)[0]
+            for _, val in right_specs
+        )
+
+        FLAG_W = u(self.FLAG_WIDTH)
+        FLAG_MARGIN = u(14)
+
+        # Anchor: flag right edge at canvas_right - 10
+        flag_right  = self.width - u(10)
+        flag_x_base = flag_right - FLAG_W
+        right_col_value_x = flag_x_base - FLAG_MARGIN - max_right_value_w
+        right_col_label_x = right_col_value_x - column_gap - max_right_label_w
+
+        # Max width for left column values = gap to right label minus padding
+        left_value_max_w = right_col_label_x - left_col_value_x - u(35)
+
+        for i, (label, value) in enumerate(left_specs):
+            y = specs_start_y + i * line_height
+            draw.text((left_col_label_x, y), label, fill=self.TEXT_COLOR, font=font_spec_label)
+            display_value = self.truncate_text(value, font_spec_value, left_value_max_w)
+            draw.text((left_col_value_x, y), display_value, fill=self.TEXT_COLOR, font=font_spec_value)
+
+        for i, (label, value) in enumerate(right_specs):
+            y = specs_start_y + i * line_height
+            draw.text((right_col_label_x, y), label, fill=self.TEXT_COLOR, font=font_spec_label)
+            draw.text((right_col_value_x,  y), value, fill=self.TEXT_COLOR, font=font_spec_value)
+        
+        # ============ 4. ФЛАГ СТРАНЫ ============
+        
+        country = specs.get('country', '')
+        if country:
+            # Флаг — позиция уже вычислена выше как flag_x_base
+            flag_y = specs_start_y + line_height + u(4)
+            self.draw_flag(draw, country, flag_x_base, flag_y)
+        
+        return draw
+    
+    # Постер-сравнение: колонки таблицы (ключ, заголовок, ширина в единицах)
+    COMPARISON_COLUMNS = [
+        ('power', "Power", 80),
+        ('torque', "Torque", 80),
+        ('acceleration', "0-100", 60),
+        ('top_speed', "Top speed", 90),
+        ('weight', "Weight", 80),
+    ]
+    COMPARISON_STRIPE = (244, 244, 244)  # Зебра строк таблицы
+    COMPARISON_MIN_ROW = 24              # Минимальная высота строки (читаемый шрифт)
+    COMPARISON_SHEET_ROWS = 20           # Версий на одном листе сравнения
+    
+    def compose_comparison(self, family: str, variants: List[Dict],
+                           photo: Optional[Image.Image], note: str = "") -> _DrawRecorder:
+        """
+        Вёрстка постера-сравнения: шапка, фото, таблица версий. Строки
+        подгоняются по высоте, но не ниже COMPARISON_MIN_ROW; не влезшие
+        версии отбрасываются с пометкой внизу (note — подпись листа).
+        """
+        u = self.u
+        draw = _DrawRecorder()
+        margin_left = u(self.MARGIN_LEFT)
+        right_edge = self.width - margin_left
+        
+        # Шапка — по общему для всех версий названию
+        header_bottom = self._compose_header(draw, family)
+        
+        # Фото ниже, чем на обычном постере — место под таблицу
+        car_bg_y = header_bottom + u(30)
+        car_bg_height = int(self.height * 0.25)
+        self._compose_car_block(draw, photo, car_bg_y, car_bg_height)
+        
+        # --- Таблица ---
+        table_top = car_bg_y + car_bg_height + u(30)
+        footer_y = self.height - u(40)          # Строка под подпись листа / пометку
+        available = footer_y - u(10) - table_top
+        rows = max(1, len(variants)) + 1       # + строка заголовков
+        row_h = max(u(self.COMPARISON_MIN_ROW), min(u(30), available // rows))
+        fit = max(1, available // row_h - 1)
+        hidden = len(variants) - fit
+        if hidden > 0:
+            log.warning(f"Comparison table fits {fit} of {len(variants)} variants")
+            variants = variants[:fit]
+            note = " · ".join(filter(None, [note, f"+{hidden} more variants not shown"]))
+        font_size = max(6, min(u(13), int(row_h * 0.55)))
+        try:
+            font_label = ImageFont.truetype(self.font_path_bold, font_size)
+            font_value = ImageFont.truetype(self.font_path_regular, font_size)
+        except:
+            font_label = font_value = ImageFont.load_default()
+        text_dy = (row_h - (font_value.getbbox("0")[3] - font_value.getbbox("0")[1])) // 2
+        
+        # Колонки значений — от правого края, имя версии занимает остаток
+        col_x = []
+        x = right_edge
+        for _, _, width in reversed(self.COMPARISON_COLUMNS):
+            x -= u(width)
+            col_x.insert(0, x)
+        name_max_w = col_x[0] - margin_left - u(self.COLUMN_GAP)
+        
+        y = table_top
+        draw.text((margin_left, y + text_dy), "Version", fill=self.TEXT_COLOR, font=font_label)
+        for (_, label, _), cx in zip(self.COMPARISON_COLUMNS, col_x):
+            draw.text((cx, y + text_dy), label, fill=self.TEXT_COLOR, font=font_label)
+        y += row_h
+        draw.line([(margin_left, y), (right_edge, y)], fill=self.LINE_COLOR, width=max(1, u(2)))
+        
+        family_prefix = family.lower()
+        for i, variant in enumerate(variants):
+            if i % 2:
+                draw.rectangle([(margin_left, y), (right_edge, y + row_h)], fill=self.COMPARISON_STRIPE)
+            name = variant.get('model', '')
+            # Общий для всех версий префикс не повторяем
+            if name.lower().startswith(family_prefix) and len(name) > len(family):
+                name = name[len(family):].strip(' -–')
+            name = self.truncate_text(name, font_value, name_max_w)
+            draw.text((margin_left, y + text_dy), name, fill=self.TEXT_COLOR, font=font_value)
+            for (key, _, width), cx in zip(self.COMPARISON_COLUMNS, col_x):
+                value = self.truncate_text(variant.get(key) or 'N/A', font_value, u(width) - u(6))
+                draw.text((cx, y + text_dy), value, fill=self.TEXT_COLOR, font=font_value)
+            y += row_h
+        
+        if note:
+            note_w = font_value.getbbox(note)[2]
+            draw.text((right_edge - note_w, footer_y), note, fill=self.LINE_COLOR, font=font_value)
+        
+        return draw
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  FALLBACK ХРАНИЛИЩЕ (ИНДЕКСИРОВАННЫЙ ДАТАСЕТ)
+# ═══════════════════════════════════════════════════════════════════════════
+SPEC_FIELDS = ['engine', 'power', 'torque', 'acceleration', 'top_speed', 'weight', 'year']
+_STORE_COLUMNS = ['model'] + SPEC_FIELDS + ['country']
+_YEAR_RE = re.compile(r'\b((?:19|20)\d{2})\b')
+
+
+def normalize_key(text: str) -> str:
+    """Нормализует название авто в ключ поиска: 'Audi TT-RS' -> 'audi tt rs'."""
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', text.lower()).split())
+
+
+def split_year(text: str):
+    """Отделяет год выпуска от названия: 'BMW M4 2022' -> ('BMW M4', 2022)."""
+    match = _YEAR_RE.search(text)
+    if not match:
+        return text, None
+    rest = (text[:match.start()] + text[match.end():]).strip()
+    return ' '.join(rest.split()), int(match.group(1))
+
+
+def _year_range(year: str):
+    """'2016-2023' -> (2016, 2023), '2019' -> (2019, 2019)."""
+    years = [int(y) for y in _YEAR_RE.findall(year or '')]
+    if not years:
+        return None, None
+    return min(years), max(years)
+
+
+class FallbackStore:
+    """
+    Fallback-характеристики из индексированной SQLite базы.
+
+    Открывается лениво при первом запросе: стоимость старта не зависит от
+    размера датасета, SQLite подгружает (через mmap) только страницы индекса
+    и строки, которые реально запрошены. CSV один раз конвертируется в
+    соседний файл ``<name>.csv.sqlite`` и пересобирается, если CSV новее.
+    Без внешнего датасета используется встроенный FALLBACK_DB.
+    """
+
+    MMAP_SIZE = 256 * 1024 * 1024
+
+    def __init__(self, path: str = ""):
+        self.path = Path(path) if path else None
+        self._conn = None
+
+    # --- Открытие / сборка индекса ---
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is not None:
+            return self._conn
+
+        if self.path is None:
+            conn = sqlite3.connect(':memory:')
+            self._create_schema(conn)
+            self._insert_rows(conn, (
+                dict(value, model=value.get('model', key), key=key)
+                for key, value in FALLBACK_DB.items()
+            ))
+        else:
+            db_path = self.path
+            if self.path.suffix.lower() == '.csv':
+                db_path = self._build_from_csv(self.path)
+            log.info(f"Opening fallback dataset: {db_path}")
+            conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+            conn.execute(f"PRAGMA mmap_size={self.MMAP_SIZE}")
+
+        conn.row_factory = sqlite3.Row
+        self._conn = conn
+        return conn
+
+    @staticmethod
+    def _create_schema(conn: sqlite3.Connection):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS specs ("
+            "key TEXT NOT NULL, year_from INTEGER, year_to INTEGER, "
+            + ', '.join(f"{col} TEXT" for col in _STORE_COLUMNS) + ")"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_specs_key ON specs(key)")
+
+    @staticmethod
+    def _insert_rows(conn: sqlite3.Connection, rows):
+        def prepared():
+            for row in rows:
+                # Полное имя 'Brand Model' — постер берёт бренд из первого слова
+                brand = (row.get('brand') or '').strip()
+                model = (row.get('model') or '').strip()
+                if brand and not model.lower().startswith(brand.lower()):
+                    model = f"{brand} {model}"
+                key = normalize_key(row.get('key') or '') or normalize_key(model)
+                if not key:
+                    continue
+                row = dict(row, model=model)
+                year_from, year_to = _year_range(row.get('year', ''))
+                yield [key, year_from, year_to] + [row.get(col) or None for col in _STORE_COLUMNS]
+
+        placeholders = ', '.join('?' * (3 + len(_STORE_COLUMNS)))
+        conn.executemany(
+            f"INSERT INTO specs (key, year_from, year_to, {', '.join(_STORE_COLUMNS)}) "
+            f"VALUES ({placeholders})",
+            prepared(),
+        )
+        conn.commit()
+
+    def _build_from_csv(self, csv_path: Path) -> Path:
+        """Конвертирует CSV в SQLite-индекс (потоково, без загрузки в память)."""
+        db_path = csv_path.with_name(csv_path.name + '.sqlite')
+        if db_path.exists() and db_path.stat().st_mtime >= csv_path.stat().st_mtime:
+            return db_path
+
+        log.info(f"Building fallback index from {csv_path}...")
+        tmp_path = db_path.with_name(db_path.name + '.tmp')
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+        conn = sqlite3.connect(tmp_path)
+        try:
+            self._create_schema(conn)
+            with open(csv_path, newline='', encoding='utf-8') as f:
+                self._insert_rows(conn, csv.DictReader(f))
+        except BaseException:
+            conn.close()
+            tmp_path.unlink(missing_ok=True)
+            raise
+        conn.close()
+        os.replace(tmp_path, db_path)
+        log.info(f"Fallback index saved to {db_path}")
+        return db_path
+
+    # --- Поиск ---
+
+    def _query(self, where: str, params, year: Optional[int]) -> Optional[sqlite3.Row]:
+        # При указанном годе предпочитаем строки, чей диапазон его покрывает
+        year_rank = "CASE WHEN year_from <= :year AND year_to >= :year THEN 0 ELSE 1 END, " if year else ""
+        sql = (
+            f"SELECT * FROM specs WHERE {where} "
+            f"ORDER BY {year_rank}length(key), year_to DESC LIMIT 1"
+        )
+        return self._connect().execute(sql, dict(params, year=year)).fetchone()
+
+    def lookup(self, car_query: str) -> Optional[Dict]:
+        """
+        Ищет характеристики по нормализованному brand+model(+year).
+
+        Порядок: точное совпадение → записи, начинающиеся с запроса
+        ('ferrari 488' → 'ferrari 488 gtb') → запрос, укороченный по словам
+        ('porsche 911 carrera s' → 'porsche 911'). Один только бренд
+        никогда не считается совпадением.
+        """
+        name, year = split_year(car_query)
+        words = normalize_key(name).split()
+        if len(words) < 2:
+            return None
+        key = ' '.join(words)
+
+        try:
+            row = self._find(words, key, year)
+        except (sqlite3.Error, OSError, csv.Error, UnicodeDecodeError) as e:
+            if self.path is None:
+                log.error(f"Fallback lookup failed: {e}")
+                return None
+            # Битый / нечитаемый датасет — дальше работаем со встроенным минимумом
+            log.error(f"Fallback dataset {self.path} is unusable ({e}), using built-in data")
+            self.close()
+            self.path = None
+            return self.lookup(car_query)
+
+        if row is None:
+            return None
+        log.info(f"Fallback match: {row['key']}")
+        return {col: row[col] for col in _STORE_COLUMNS if row[col]}
+
+    def _find(self, words: List[str], key: str, year: Optional[int]) -> Optional[sqlite3.Row]:
+        row = self._query("key = :key", {'key': key}, year)
+        if row is None:
+            # Диапазон по индексу: 'key ' <= k < 'key!' — продолжение по границе слова
+            row = self._query("key >= :lo AND key < :hi", {'lo': key + ' ', 'hi': key + '!'}, year)
+        for n in range(len(words) - 1, 1, -1):
+            if row is not None:
+                break
+            row = self._query("key = :key", {'key': ' '.join(words[:n])}, year)
+        return row
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  ЖУРНАЛ БАТЧА (ВОЗОБНОВЛЕНИЕ ПОСЛЕ ПАДЕНИЯ)
+# ═══════════════════════════════════════════════════════════════════════════
+class BatchJournal:
+    """
+    Append-only журнал батча в формате JSON Lines: одна запись на каждый
+    завершённый этап машины (url → specs → photo → output) или ошибку.
+    Каждая запись сбрасывается на диск сразу, поэтому после падения Chrome,
+    таймаута Cloudflare или сбоя remove.bg перезапуск продолжает каждую
+    машину с последнего завершённого этапа.
+    """
+
+    STAGES = ('url', 'specs', 'photo', 'output')
+
+    def __init__(self, path: Path = None):
+        self.path = Path(path or BATCH_JOURNAL_FILE)
+        self.state: Dict[str, Dict] = {}
+        self._torn_tail = False           # Последняя строка файла не дописана
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line_no, line in enumerate(f, 1):
+                self._torn_tail = not line.endswith('\n')
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    self._apply(json.loads(line))
+                except (ValueError, KeyError):
+                    # Недописанная строка при падении процесса
+                    log.warning(f"Skipping corrupt journal line {line_no} in {self.path}")
+        log.info(f"Journal loaded: {len(self.state)} cars from {self.path}")
+
+    def _apply(self, record: Dict):
+        car_state = self.state.setdefault(record['car'], {})
+        if record['stage'] == 'failed':
+            car_state['error'] = {'stage': record['failed_stage'], 'error': record['error'],
+                                  'ts': record['ts']}
+        else:
+            car_state[record['stage']] = record['value']
+            car_state.pop('error', None)
+
+    def _append(self, record: Dict):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            if self._torn_tail:
+                f.write('\n')
+                self._torn_tail = False
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._apply(record)
+
+    def record(self, car: str, stage: str, value):
+        self._append({'ts': time.time(), 'car': car, 'stage': stage, 'value': value})
+
+    def fail(self, car: str, stage: str, error: str):
+        self._append({'ts': time.time(), 'car': car, 'stage': 'failed',
+                      'failed_stage': stage, 'error': error})
+
+    def get(self, car: str, stage: str):
+        return self.state.get(car, {}).get(stage)
+
+    def failures(self) -> Dict[str, Dict]:
+        return {car: st['error'] for car, st in self.state.items() if 'error' in st}
+
+    def summary(self) -> Dict[str, int]:
+        """Сколько машин дошло до каждого этапа (последний завершённый)."""
+        counts = {stage: 0 for stage in self.STAGES}
+        counts['failed'] = 0
+        for car_state in self.state.values():
+            if 'error' in car_state:
+                counts['failed'] += 1
+                continue
+            done = [stage for stage in self.STAGES if car_state.get(stage) is not None]
+            if done:
+                counts[done[-1]] += 1
+        return counts
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  АРХИВ СТРАНИЦ
+# ═══════════════════════════════════════════════════════════════════════════
+class PageArchive:
+    """
+    Архив сырых HTML страниц (списки моделей и страницы характеристик):
+    SQLite + zlib, ключ — URL и время загрузки. Позволяет заново прогнать
+    улучшенный парсинг по уже скачанным страницам без Chrome и сети.
+    """
+
+    def __init__(self, path: str = "", readonly: bool = False):
+        self.path = Path(path or PAGE_ARCHIVE_FILE)
+        if readonly:
+            self._conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        else:
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "url TEXT NOT NULL, fetched_at REAL NOT NULL, kind TEXT, html BLOB NOT NULL, "
+                "extract TEXT)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_pages_url ON pages(url, fetched_at)")
+            if not self._has_extract_column():
+                # Архив старого формата: режим извлечения не записывался
+                self._conn.execute("ALTER TABLE pages ADD COLUMN extract TEXT")
+            self._conn.commit()
+        self._extract_column = "extract" if self._has_extract_column() else "NULL"
+
+    def _has_extract_column(self) -> bool:
+        return any(col[1] == 'extract' for col in self._conn.execute("PRAGMA table_info(pages)"))
+
+    def put(self, url: str, html: str, kind: str = "", extract: str = ""):
+        self._conn.execute(
+            "INSERT INTO pages (url, fetched_at, kind, html, extract) VALUES (?, ?, ?, ?, ?)",
+            (url, time.time(), kind, zlib.compress(html.encode('utf-8'), 6), extract or None),
+        )
+        self._conn.commit()
+
+    def latest(self, url: str) -> Optional[str]:
+        """Последняя сохранённая версия страницы."""
+        page = self.latest_page(url)
+        return page[0] if page else None
+
+    def latest_page(self, url: str):
+        """(HTML, режим извлечения) последней версии страницы или None."""
+        row = self._conn.execute(
+            f"SELECT html, {self._extract_column} FROM pages WHERE url = ? ORDER BY fetched_at DESC LIMIT 1",
+            (url,),
+        ).fetchone()
+        return (zlib.decompress(row[0]).decode('utf-8'), row[1]) if row else None
+
+    def close(self):
+        self._conn.close()
+
+
+# Воркеры reparse: по одному read-only соединению с архивом на процесс
+_worker_archive: Optional[PageArchive] = None
+# Разобранные списки моделей по URL — один бренд обычно встречается много раз
+_worker_anchors: Dict[str, List[Dict]] = {}
+
+
+def _init_reparse_worker(archive_path: str):
+    global _worker_archive
+    _worker_archive = PageArchive(archive_path, readonly=True)
+    log.setLevel(logging.WARNING)
+
+
+def _reparse_worker(task):
+    """
+    (car, url и источник из журнала) → (car, url, specs, статус). Заново
+    выбирает модель по архивному списку бренда (только если ссылка
+    действительно содержит запрос; версии из --variants сохраняют свой
+    URL) и разбирает архивную страницу.
+    """
+    car_query, url, source = task
+    brand, model = split_car_query(car_query)
+    try:
+        if source == 'variant':
+            return _reparse_page(car_query, url)
+        list_url = AutoCatalogScraper.brand_list_url(brand)
+        if list_url not in _worker_anchors:
+            list_html = _worker_archive.latest(list_url)
+            _worker_anchors[list_url] = (
+                AutoCatalogScraper.soup_model_anchors(list_html) if list_html else []
+            )
+        if _worker_anchors[list_url]:
+            results = AutoCatalogScraper.select_model_links(_worker_anchors[list_url], model)
+            # select_model_links без совпадений отдаёт первую ссылку страницы
+            if results and model.lower() in results[0]['name'].lower():
+                url = results[0]['url']
+        return _reparse_page(car_query, url)
+    except Exception as e:
+        return car_query, url, None, f"error: {e}"
+
+
+def _reparse_page(car_query: str, url: Optional[str]):
+    """Разбор архивной страницы url тем же способом, что и при живом скрапинге."""
+    try:
+        if not url:
+            return car_query, url, None, 'no url'
+
+        page = _worker_archive.latest_page(url)
+        if page is None:
+            return car_query, url, None, 'not archived'
+        # Тот же текст, что и при живом разборе этой страницы
+        spec_html, extract = page
+        if extract == 'soup':
+            h1_text, page_text = AutoCatalogScraper.soup_spec_text(spec_html)
+        else:
+            h1_text, page_text = AutoCatalogScraper.spec_rows_text(
+                AutoCatalogScraper.soup_spec_rows(spec_html)
+            )
+        return car_query, url, AutoCatalogScraper.extract_specs(h1_text, page_text), 'ok'
+    except Exception as e:
+        return car_query, url, None, f"error: {e}"
+
+
+def reparse_archive(journal: BatchJournal, archive_path: str,
+                    fallback_store: FallbackStore, workers: int = 0) -> Dict[str, int]:
+    """
+    Офлайн повторный разбор всех машин журнала по архиву страниц,
+    параллельно на всех ядрах. Изменившиеся характеристики записываются
+    в журнал, а постер помечается для перерисовки.
+    """
+    tasks = [(car, st.get('url'), st.get('source')) for car, st in journal.state.items()]
+    workers = workers or os.cpu_count() or 1
+    log.info(f"Reparsing {len(tasks)} cars from {archive_path} with {workers} workers...")
+    started = time.time()
+
+    counts = {'updated': 0, 'unchanged': 0, 'url_changed': 0, 'missing': 0, 'failed': 0}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_reparse_worker,
+                             initargs=(str(archive_path),)) as pool:
+        for car_query, url, specs, status in pool.map(_reparse_worker, tasks, chunksize=16):
+            if url and url != journal.get(car_query, 'url'):
+                # Модель теперь выбирается иначе — старые данные недействительны
+                counts['url_changed'] += 1
+                journal.record(car_query, 'url', url)
+                if specs is None:
+                    journal.record(car_query, 'specs', None)
+                    journal.record(car_query, 'output', None)
+            if specs is None:
+                counts['missing' if status in ('no url', 'not archived') else 'failed'] += 1
+                if status.startswith('error'):
+                    log.warning(f"{car_query}: {status}")
+                continue
+
+            brand, _ = split_car_query(car_query)
+            specs = complete_specs(specs, car_query, brand, fallback_store)
+            if specs == journal.get(car_query, 'specs'):
+                counts['unchanged'] += 1
+                continue
+            journal.record(car_query, 'specs', specs)
+            journal.record(car_query, 'output', None)
+            counts['updated'] += 1
+
+    log.info(f"Reparse finished in {time.time() - started:.1f}s: {counts}")
+    return counts
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+#  ТИПИЗИРОВАННЫЕ ХАРАКТЕРИСТИКИ + КОЛОНОЧНЫЙ ЭКСПОРТ
+# ═══════════════════════════════════════════════════════════════════════════
+_NUM_RE = re.compile(r'(\d+(?:[.,]\d+)?)')
+
+
+def _parse_number(text) -> float:
+    """'394 HP' -> 394.0, '3,7 s' -> 3.7, пусто / 'N/A' -> nan."""
+    match = _NUM_RE.search(str(text or ''))
+    return float(match.group(1).replace(',', '.')) if match else math.nan
+
+
+def _format_number(value: float) -> str:
+    return f"{value:g}" if value != int(value) else str(int(value))
+
+
+class SpecRecord:
+    """
+    Компактная запись характеристик: числа в нормализованных единицах
+    (HP, Nm, s, km/h, kg, литры) вместо строк "394 HP". __slots__ — без
+    __dict__ на каждую запись. Отсутствующее значение — nan (год — 0).
+    """
+
+    __slots__ = ('model', 'engine', 'country', 'engine_l', 'power_hp', 'torque_nm',
+                 'accel_s', 'top_speed_kmh', 'weight_kg', 'year_from', 'year_to')
+
+    # Числовые колонки: поле → (ключ словаря specs, единица для отображения)
+    NUMERIC = {
+        'power_hp': ('power', 'HP'),
+        'torque_nm': ('torque', 'Nm'),
+        'accel_s': ('acceleration', 's'),
+        'top_speed_kmh': ('top_speed', 'km/h'),
+        'weight_kg': ('weight', 'kg'),
+    }
+    STRINGS = ('model', 'engine', 'country')
+    FLOATS = ('engine_l', 'power_hp', 'torque_nm', 'accel_s', 'top_speed_kmh', 'weight_kg')
+    INTS = ('year_from', 'year_to')
+
+    def __init__(self, model: str = '', engine: str = '', country: str = '',
+                 engine_l: float = math.nan, power_hp: float = math.nan,
+                 torque_nm: float = math.nan, accel_s: float = math.nan,
+                 top_speed_kmh: float = math.nan, weight_kg: float = math.nan,
+                 year_from: int = 0, year_to: int = 0):
+        self.model = model
+        self.engine = engine
+        self.country = country
+        self.engine_l = engine_l
+        self.power_hp = power_hp
+        self.torque_nm = torque_nm
+        self.accel_s = accel_s
+        self.top_speed_kmh = top_speed_kmh
+        self.weight_kg = weight_kg
+        self.year_from = year_from
+        self.year_to = year_to
+
+    @classmethod
+    def from_specs(cls, specs: Dict) -> "SpecRecord":
+        """Из словаря parse_specs() / complete_specs() со строками для отображения."""
+        engine = specs.get('engine') or ''
+        engine_l = math.nan
+        match = re.search(r'(\d+(?:\.\d+)?)\s*cm3', engine, re.IGNORECASE)
+        if match:
+            engine_l = float(match.group(1)) / 1000
+        else:
+            match = re.search(r'(\d+(?:\.\d+)?)\s*l\b', engine, re.IGNORECASE)
+            if match:
+                engine_l = float(match.group(1))
+
+        year_from, year_to = _year_range(specs.get('year', ''))
+        return cls(
+            model=specs.get('model') or '',
+            engine='' if engine == 'N/A' else engine,
+            country=specs.get('country') or '',
+            engine_l=engine_l,
+            year_from=year_from or 0,
+            year_to=year_to or 0,
+            **{field: _parse_number(specs.get(key)) for field, (key, _) in cls.NUMERIC.items()},
+        )
+
+    def to_specs(self) -> Dict:
+        """Строки для PosterGenerator: {'power': '394 HP', ...}."""
+        specs = {'model': self.model}
+        if self.engine:
+            specs['engine'] = self.engine
+        for field, (key, unit) in self.NUMERIC.items():
+            value = getattr(self, field)
+            if not math.isnan(value):
+                specs[key] = f"{_format_number(value)} {unit}"
+        if self.year_from:
+            specs['year'] = (str(self.year_from) if self.year_from == self.year_to
+                             else f"{self.year_from}-{self.year_to}")
+        if self.country:
+            specs['country'] = self.country
+        return specs
+
+    @property
+    def power_to_weight(self) -> float:
+        """HP на тонну."""
+        return self.power_hp / (self.weight_kg / 1000) if self.weight_kg else math.nan
+
+    def __repr__(self):
+        return f"SpecRecord({self.model!r}, {self.power_hp:g} HP, {self.weight_kg:g} kg)"
+
+
+def export_columns(records, out_dir: str) -> int:
+    """
+    Колоночный экспорт: по файлу на колонку. Числа — сырые little-endian
+    массивы (<f8 / <i4), читаются как numpy.memmap без разбора; строки —
+    JSON-список. Схема и число строк — в schema.json.
+    """
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    floats = {name: array('d') for name in SpecRecord.FLOATS}
+    ints = {name: array('i') for name in SpecRecord.INTS}
+    strings = {name: [] for name in SpecRecord.STRINGS}
+
+    rows = 0
+    for record in records:
+        for name, column in floats.items():
+            column.append(getattr(record, name))
+        for name, column in ints.items():
+            column.append(getattr(record, name))
+        for name, column in strings.items():
+            column.append(getattr(record, name))
+        rows += 1
+
+    schema = {'rows': rows, 'columns': {}}
+    for columns, dtype in ((floats, '<f8'), (ints, '<i4')):
+        for name, column in columns.items():
+            if sys.byteorder != 'little':
+                column.byteswap()
+            with open(out / f"{name}.bin", 'wb') as f:
+                column.tofile(f)
+            schema['columns'][name] = dtype
+    for name, column in strings.items():
+        with open(out / f"{name}.json", 'w', encoding='utf-8') as f:
+            json.dump(column, f, ensure_ascii=False)
+        schema['columns'][name] = 'str'
+    with open(out / 'schema.json', 'w', encoding='utf-8') as f:
+        json.dump(schema, f, indent=2)
+
+    log.info(f"Exported {rows} spec records to {out}")
+    return rows
+
+
+def load_columns(in_dir: str) -> Dict:
+    """Загружает колоночный экспорт: числа — numpy.memmap, строки — numpy-массив."""
+    import numpy as np
+
+    src = Path(in_dir)
+    with open(src / 'schema.json', 'r', encoding='utf-8') as f:
+        schema = json.load(f)
+    columns = {}
+    for name, dtype in schema['columns'].items():
+        if dtype == 'str':
+            with open(src / f"{name}.json", 'r', encoding='utf-8') as f:
+                columns[name] = np.array(json.load(f), dtype=object)
+        elif schema['rows']:
+            columns[name] = np.memmap(src / f"{name}.bin", dtype=dtype, mode='r')
+        else:
+            columns[name] = np.zeros(0, dtype=dtype)
+    return columns
+
+
+def rank_columns(columns: Dict, key: str, top: int = 20, ascending: bool = False):
+    """
+    Векторный рейтинг по колонке или производной метрике ('power_to_weight').
+    Машины без значения в рейтинг не попадают. Возвращает индексы строк.
+    """
+    import numpy as np
+
+    if key == 'power_to_weight':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = columns['power_hp'] / (columns['weight_kg'] / 1000)
+    else:
+        values = np.asarray(columns[key], dtype='f8')
+    valid = np.flatnonzero(np.isfinite(values))
+    order = np.argsort(values[valid], kind='stable')
+    if not ascending:
+        order = order[::-1]
+    return valid[order[:top]], values
 
 
 # ═══════════════════════════════════════════════════════════════════════════
 #  MAIN
 # ═══════════════════════════════════════════════════════════════════════════
+def complete_specs(specs: Dict, car_query: str, brand: str,
+                   fallback_store: FallbackStore) -> Dict:
+    """Дополняет характеристики из fallback-базы и добавляет страну производителя."""
+    # Fallback ДОПОЛНЯЕТ недостающие данные (не заменяет!)
+    if specs:
+        fallback = fallback_store.lookup(car_query)
+        
+        if fallback:
+            # Дополняем ТОЛЬКО отсутствующие поля
+            for key in SPEC_FIELDS:
+                if key not in specs or not specs.get(key):
+                    specs[key] = fallback.get(key, 'N/A')
+            log.info(f"Filled missing specs from fallback")
+    else:
+        # Если парсинг совсем не сработал
+        specs = {'model': car_query}
+        fallback = fallback_store.lookup(car_query)
+        if fallback:
+            specs.update(fallback)
+    
+    # Страна
+    if 'country' not in specs or not specs['country']:
+        specs['country'] = BRAND_COUNTRIES.get(brand.lower(), '')
+    
+    return specs
+
+
+def variant_output(output_file: str, index: int, name: str) -> str:
+    """poster_Porsche_911.png + 'Carrera S' -> poster_Porsche_911_03_Carrera_S.png"""
+    path = Path(output_file)
+    slug = re.sub(r'[^0-9A-Za-z]+', '_', name).strip('_') or 'variant'
+    return str(path.with_name(f"{path.stem}_{index:02d}_{slug}{path.suffix}"))
+
+
+def split_car_query(car_query: str):
+    """'Porsche 911 Carrera' -> ('Porsche', '911 Carrera')"""
+    parts = car_query.split(None, 1)
+    return parts[0], (parts[1] if len(parts) > 1 else "")
+
+
+def default_output_name(car_query: str) -> str:
+    return f"poster_{car_query.replace(' ', '_')}.png"
+
+
+def read_batch_file(path: str) -> List[str]:
+    """Список машин: по одной на строку, пустые строки и # комментарии пропускаются."""
+    cars = []
+    seen = set()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#') and line not in seen:
+                seen.add(line)
+                cars.append(line)
+    return cars
+
+
+def run_batch(cars: List[str], journal: BatchJournal, scraper: AutoCatalogScraper,
+              fetcher: ImageFetcher, generator: PosterGenerator,
+              fallback_store: FallbackStore, output_dir: str = "", force: bool = False):
+    """
+    Обрабатывает список машин, записывая каждый этап в журнал.
+    Уже завершённые этапы (URL, характеристики, фото, постер) берутся из
+    журнала — повторный запуск не повторяет скрапинг и платные вызовы API.
+    """
+    for n, car_query in enumerate(cars, 1):
+        log.info("=" * 70)
+        log.info(f"  [{n}/{len(cars)}] {car_query}")
+        log.info("=" * 70)
+        
+        output = journal.get(car_query, 'output')
+        if output and Path(output).exists() and not force:
+            log.info(f"Already done: {output}")
+            continue
+        
+        brand, model = split_car_query(car_query)
+        stage = 'url'
+        try:
+            # 1. URL страницы характеристик
+            url = journal.get(car_query, 'url')
+            if url is None:
+                search_results = scraper.search_car(brand, model)
+                if not search_results:
+                    raise RuntimeError("no search results")
+                url = search_results[0]['url']
+                log.info(f"Selected model: {search_results[0]['name']}")
+                journal.record(car_query, 'url', url)
+            
+            # 2. Характеристики
+            stage = 'specs'
+            specs = journal.get(car_query, 'specs')
+            if specs is None:
+                specs = scraper.parse_specs(url)
+                if not specs:
+                    raise RuntimeError(f"could not parse specs from {url}")
+                specs = complete_specs(specs, car_query, brand, fallback_store)
+                journal.record(car_query, 'specs', specs)
+            
+            # 3. Фото (кэш — чтобы не платить за remove.bg повторно)
+            stage = 'photo'
+            photo_key = journal.get(car_query, 'photo')
+            photo = fetcher.load_from_cache(photo_key) if photo_key else None
+            photo_failed = False
+            if photo is None:
+                photo = fetcher.get(brand, model)
+                # Фото без удалённого фона / без фото из-за сбоя API не
+                # кэшируется и не считается готовым — машина будет повторена
+                photo_failed = fetcher.degraded
+                if photo is not None and not photo_failed:
+                    photo_key = fetcher.cache_key(brand, model)
+                    fetcher.save_to_cache(photo_key, photo)
+                    journal.record(car_query, 'photo', photo_key)
+            
+            # 4. Постер (при сбое фото — черновой, этап output не записывается)
+            stage = 'output'
+            output = str(Path(output_dir) / default_output_name(car_query))
+            if not generator.generate(specs, photo, output, force=force):
+                raise RuntimeError("poster generation failed")
+            if photo_failed:
+                stage = 'photo'
+                raise RuntimeError("photo API unavailable, draft poster rendered; will retry")
+            journal.record(car_query, 'output', output)
+            
+        except KeyboardInterrupt:
+            raise
+        except Exception as e:
+            log.error(f"{car_query}: failed at stage '{stage}': {e}")
+            journal.fail(car_query, stage, str(e))
+    
+    counts = journal.summary()
+    log.info(f"Batch finished: {counts['output']} done, {counts['failed']} failed")
+
+
+def print_journal_summary(journal: BatchJournal):
+    """Сводка по журналу батча + список ошибок для повторного запуска."""
+    counts = journal.summary()
+    failures = journal.failures()
+    
+    print()
+    print("=" * 70)
+    print(f"  JOURNAL: {journal.path} ({len(journal.state)} cars)")
+    print("=" * 70)
+    for stage in BatchJournal.STAGES:
+        print(f"  last completed stage '{stage}': {counts[stage]}")
+    print(f"  failed: {counts['failed']}")
+    
+    if failures:
+        print()
+        print("  FAILURES:")
+        for car, error in sorted(failures.items()):
+            when = time.strftime('%Y-%m-%d %H:%M', time.localtime(error['ts']))
+            print(f"    {car:<30} {error['stage']:<7} {when}  {error['error']}")
+        print()
+        print("  Retry only these cars:")
+        print(f"    python auto_poster.py --batch <file> --journal {journal.path} --retry-failed")
+    print()
+
+
+def print_ranking(columns_dir: str, key: str, top: int):
+    """Топ машин по числовой характеристике из колоночного экспорта."""
+    columns = load_columns(columns_dir)
+    indices, values = rank_columns(columns, key, top)
+    
+    print()
+    print("=" * 70)
+    print(f"  TOP {len(indices)} BY {key.upper()} ({len(values)} cars)")
+    print("=" * 70)
+    for place, i in enumerate(indices, 1):
+        print(f"  {place:>3}. {columns['model'][i]:<45} {values[i]:10.1f}")
+    print()
+
+
 def main():
     print_banner()
     
     parser = argparse.ArgumentParser(description="Auto Poster Generator v5.0")
-    parser.add_argument("--car", required=True, help='Car name (e.g. "Porsche 911")')
-    parser.add_argument("--output", default="", help="Output filename")
+    parser.add_argument("--car", help='Car name (e.g. "Porsche 911")')
+    parser.add_argument("--batch", help="File with car names, one per line (resumable batch run)")
+    parser.add_argument("--journal", default=str(BATCH_JOURNAL_FILE),
+                        help=f"Batch journal file (default: {BATCH_JOURNAL_FILE})")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="With --batch: process only cars that failed according to the journal")
+    parser.add_argument("--journal-summary", action="store_true",
+                        help="Print batch journal summary and failures, then exit")
+    parser.add_argument("--output", default="",
+                        help="Output filename (with --batch: output directory)")
+    parser.add_argument("--fallback-db", default=FALLBACK_DB_PATH,
+                        help="Fallback specs dataset (CSV or SQLite)")
+    parser.add_argument("--force", action="store_true",
+                        help="Re-render even if the poster is up to date")
+    parser.add_argument("--print", dest="print_mode", action="store_true",
+                        help="Render a 300 dpi print poster (7200x10800) in memory-bounded strips")
+    parser.add_argument("--extract", choices=["script", "soup"], default="script",
+                        help="Page data extraction: in-browser script (default) or full page_source + BeautifulSoup")
+    parser.add_argument("--no-block-resources", dest="block_resources", action="store_false",
+                        help="Load images, fonts, stylesheets and third-party scripts while scraping")
+    parser.add_argument("--page-stats", action="store_true",
+                        help="Report bytes transferred and load time per scraped page")
+    parser.add_argument("--variants", choices=["posters", "compare"], default=None,
+                        help="Crawl all matching variants: one poster each, or a single comparison poster")
+    parser.add_argument("--max-variants", type=int, default=40,
+                        help="Max variants crawled with --variants (default: 40)")
+    parser.add_argument("--tabs", type=int, default=4,
+                        help="Max browser tabs loading variant pages concurrently (default: 4)")
+    parser.add_argument("--columns-dir", default="spec_columns",
+                        help="Columnar spec export directory (default: spec_columns)")
+    parser.add_argument("--export-columns", action="store_true",
+                        help="Export specs of all journaled cars to --columns-dir, then exit")
+    parser.add_argument("--rank", metavar="FIELD",
+                        choices=list(SpecRecord.FLOATS) + ['power_to_weight'],
+                        help="Rank exported cars by a numeric field (requires numpy), then exit")
+    parser.add_argument("--top", type=int, default=20, help="Number of cars to show with --rank")
+    parser.add_argument("--archive", nargs="?", const=str(PAGE_ARCHIVE_FILE), default=None,
+                        metavar="PATH",
+                        help=f"Archive raw HTML of every scraped page (default: {PAGE_ARCHIVE_FILE})")
+    parser.add_argument("--reparse", action="store_true",
+                        help="Re-parse all journaled cars from the page archive offline, then exit")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Worker processes for --reparse (default: all cores)")
+    parser.add_argument("--profile", action="store_true",
+                        help="cProfile each pipeline stage, write <stage>.pstats to --profile-dir")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Trace allocations per stage (tracemalloc), write memory_report.txt")
+    parser.add_argument("--profile-dir", default="profile",
+                        help="Directory for profiling reports (default: profile)")
+    parser.add_argument("--browser-address", default="", metavar="HOST:PORT",
+                        help="Attach to a running Chrome started with --remote-debugging-port")
+    parser.add_argument("--reuse-browser", action="store_true",
+                        help="Attach to the managed long-lived browser, (re)launching it if needed")
+    parser.add_argument("--start-browser", action="store_true",
+                        help="Start the managed long-lived browser, then exit")
+    parser.add_argument("--stop-browser", action="store_true",
+                        help="Stop the managed long-lived browser, then exit")
+    parser.add_argument("--browser-port", type=int, default=9222,
+                        help="DevTools port of the managed browser (default: 9222)")
     args = parser.parse_args()
     
-    car_query = args.car.strip()
-    output_file = args.output or f"poster_{car_query.replace(' ', '_')}.png"
-    
-    log.info("=" * 70)
-    log.info(f"  CAR: {car_query}")
-    log.info(f"  OUTPUT: {output_file}")
-    log.info("=" * 70)
+    if args.start_browser:
+        ManagedBrowser(args.browser_port).start()
+        return
+    if args.stop_browser:
+        ManagedBrowser(args.browser_port).stop()
+        return
+    if args.fallback_db and not Path(args.fallback_db).is_file():
+        parser.error(f"fallback dataset not found: {args.fallback_db}")
+    if args.journal_summary:
+        print_journal_summary(BatchJournal(args.journal))
+        return
+    if args.export_columns:
+        journal = BatchJournal(args.journal)
+        records = (SpecRecord.from_specs(st['specs']) for st in journal.state.values() if st.get('specs'))
+        export_columns(records, args.columns_dir)
+        return
+    if args.rank:
+        print_ranking(args.columns_dir, args.rank, args.top)
+        return
+    if args.reparse:
+        archive_path = args.archive or str(PAGE_ARCHIVE_FILE)
+        if not Path(archive_path).exists():
+            parser.error(f"page archive not found: {archive_path}")
+        fallback_store = FallbackStore(args.fallback_db)
+        try:
+            reparse_archive(BatchJournal(args.journal), archive_path, fallback_store, args.workers)
+        finally:
+            fallback_store.close()
+        return
+    if not args.car and not args.batch:
+        parser.error("one of --car, --batch or --journal-summary is required")
+    if args.batch and args.variants:
+        parser.error("--variants cannot be combined with --batch")
+    if args.variants and not split_car_query(args.car)[1]:
+        # Без модели под фильтр попадает каждая ссылка на странице бренда
+        parser.error('--variants needs a model, e.g. --car "Porsche 911"')
     
     scraper = None
-    specs = {}
+    fallback_store = FallbackStore(args.fallback_db)
+    archive = PageArchive(args.archive) if args.archive else None
+    profiler.configure(args.profile_dir, cpu=args.profile, memory=args.trace_memory)
     
     try:
-        parts = car_query.split(None, 1)
-        brand = parts[0]
-        model = parts[1] if len(parts) > 1 else ""
+        scraper = AutoCatalogScraper(
+            extract_mode=args.extract,
+            block_resources=args.block_resources,
+            page_stats=args.page_stats,
+            archive=archive,
+            debugger_address=args.browser_address,
+            managed_browser=ManagedBrowser(args.browser_port) if args.reuse_browser else None,
+        )
+        generator = PosterGenerator.for_print() if args.print_mode else PosterGenerator()
         
-        # 1. Парсинг
-        scraper = AutoCatalogScraper()
-        search_results = scraper.search_car(brand, model)
-        
-        if search_results:
-            first_result = search_results[0]
-            log.info(f"Selected model: {first_result['name']}")
-            
-            specs = scraper.parse_specs(first_result['url'])
-        
-        # 2. Fallback ДОПОЛНЯЕТ недостающие данные (не заменяет!)
-        if specs:
-            car_key = car_query.lower().strip()
-            fallback = FALLBACK_DB.get(car_key)
-            
-            if not fallback:
-                for key, value in FALLBACK_DB.items():
-                    if brand.lower() in key:
-                        fallback = value
-                        break
-            
-            if fallback:
-                # Дополняем ТОЛЬКО отсутствующие поля
-                for key in ['engine', 'power', 'torque', 'acceleration', 'top_speed', 'weight', 'year']:
-                    if key not in specs or not specs.get(key):
-                        specs[key] = fallback.get(key, 'N/A')
-                log.info(f"Filled missing specs from fallback")
-        else:
-            # Если парсинг совсем не сработал
-            specs = {'model': car_query}
-            car_key = car_query.lower().strip()
-            fallback = FALLBACK_DB.get(car_key)
-            if fallback:
-                specs.update(fallback)
+        if args.batch:
+            journal = BatchJournal(args.journal)
+            cars = read_batch_file(args.batch)
+            if args.retry_failed:
+                failed = journal.failures()
+                cars = [car for car in cars if car in failed]
+            log.info(f"Batch: {len(cars)} cars, journal: {journal.path}")
+            
+            if args.output:
+                Path(args.output).mkdir(parents=True, exist_ok=True)
+            run_batch(cars, journal, scraper, ImageFetcher(), generator, fallback_store,
+                      output_dir=args.output, force=args.force)
+            print_journal_summary(journal)
+            return
         
-        # Страна
-        if 'country' not in specs or not specs['country']:
-            specs['country'] = BRAND_COUNTRIES.get(brand.lower(), '')
+        car_query = args.car.strip()
+        output_file = args.output or default_output_name(car_query)
         
-        log.info(f"Final specs: {specs}")
+        log.info("=" * 70)
+        log.info(f"  CAR: {car_query}")
+        log.info(f"  OUTPUT: {output_file}")
+        log.info("=" * 70)
         
-        # 3. Фото
-        fetcher = ImageFetcher()
-        photo = fetcher.get(brand, model)
+        specs = {}
+        brand, model = split_car_query(car_query)
+        # Результаты одиночных запусков тоже попадают в журнал — его
+        # читают --export-columns / --rank / --reparse
+        journal = BatchJournal(args.journal)
+        
+        # 1. Парсинг
+        search_results = scraper.search_car(brand, model, limit=None if args.variants else 20)
         
-        # 4. Постер
-        generator = PosterGenerator()
-        generator.generate(specs, photo, output_file)
+        if args.variants and search_results:
+            # Все версии модели: страницы грузятся параллельно во вкладках
+            matches = [r for r in search_results if model.lower() in r['name'].lower()]
+            matches = matches or search_results[:1]
+            if len(matches) > args.max_variants:
+                log.warning(f"{len(matches)} variants match, crawling the first {args.max_variants} "
+                            f"(see --max-variants)")
+                matches = matches[:args.max_variants]
+            log.info(f"Crawling {len(matches)} variants in up to {args.tabs} tabs")
+            variant_specs = scraper.parse_specs_many([r['url'] for r in matches], max_tabs=args.tabs)
+            
+            variants = []
+            journaled = set()
+            for result, vspecs in zip(matches, variant_specs):
+                scraped = bool(vspecs)
+                if vspecs and not vspecs.get('model'):
+                    vspecs['model'] = result['name']
+                vspecs = complete_specs(vspecs, vspecs.get('model', result['name']),
+                                        brand, fallback_store)
+                variants.append(vspecs)
+                if scraped:
+                    # Ключ — имя версии из h1, а не запрос: reparse не ищет его заново
+                    journal.record(vspecs['model'], 'source', 'variant')
+                    journal.record(vspecs['model'], 'url', result['url'])
+                    journal.record(vspecs['model'], 'specs', vspecs)
+                    journaled.add(vspecs['model'])
+            log.info(f"Collected specs for {len(variants)} variants")
+            
+            fetcher = ImageFetcher()
+            photo = fetcher.get(brand, model)
+            
+            if args.variants == "compare":
+                generator.generate_comparison(car_query, variants, photo, output_file, force=args.force)
+            else:
+                for i, vspecs in enumerate(variants, 1):
+                    voutput = variant_output(output_file, i, vspecs['model'])
+                    # Постер со сбойным фото не считается готовым (как в run_batch)
+                    if generator.generate(vspecs, photo, voutput, force=args.force) \
+                            and vspecs['model'] in journaled and not fetcher.degraded:
+                        journal.record(vspecs['model'], 'output', voutput)
+        else:
+            if search_results:
+                first_result = search_results[0]
+                log.info(f"Selected model: {first_result['name']}")
+                
+                specs = scraper.parse_specs(first_result['url'])
+            
+            # 2. Fallback + страна
+            scraped = bool(specs)
+            specs = complete_specs(specs, car_query, brand, fallback_store)
+            log.info(f"Final specs: {specs}")
+            if scraped:
+                journal.record(car_query, 'url', first_result['url'])
+                journal.record(car_query, 'specs', specs)
+            
+            # 3. Фото
+            fetcher = ImageFetcher()
+            photo = fetcher.get(brand, model)
+            
+            # 4. Постер
+            if generator.generate(specs, photo, output_file, force=args.force) \
+                    and scraped and not fetcher.degraded:
+                journal.record(car_query, 'output', output_file)
         
         print()
         print("=" * 70)
@@ -943,6 +3180,10 @@ def main():
     finally:
         if scraper:
             scraper.close()
+        fallback_store.close()
+        if archive:
+            archive.close()
+        profiler.dump()
 
 
 if __name__ == "__main__":